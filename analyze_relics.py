@@ -1,15 +1,31 @@
+import argparse
 import csv
 import difflib
+import hashlib
+import json
 import math
+import multiprocessing
 import os
+import pickle
 import re
 import sys
+import time
 import unicodedata
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 
 import cv2
 import numpy as np
 
+try:
+    import resource  # Windows には無い(ピークメモリの表示にだけ使う)
+except ImportError:
+    resource = None
+
+from frame_sources import FRAME_SOURCES, normalized_size, open_frame_source, parse_size
+
 
 def resource_path(relative_path):
     """PyInstaller でも開発環境でも同じようにパスを解決"""
@@ -43,12 +59,23 @@ CSV_PATH = os.path.join(
     output_dir,
     f"relics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
 )
+TRACE_PATH = os.path.splitext(CSV_PATH)[0] + "_trace.json"
 
 FRAME_SKIP_DIFF_TH = 1.75
+# 差分判定: "roi" は遺物パネルを間引いたシグネチャで判定、"frame" は遺物パネルをフル解像度でグレースケール化して判定
+DEFAULT_DIFF_GATE = "roi"
+DIFF_GATE_STRIDE = 4
+# パネルが何フレーム静止したら認識するか(0 なら変化したフレームを毎回認識)
+DEFAULT_SETTLE_FRAMES = 2
+SETTLE_DIFF_TH = 0.5
 CALC_BASE_WIDTH = 3840
 CALC_BASE_HEIGHT = 2160
 CALC_BASE_RELIC_NAME_CHAR_WIDTH = 50
 CALC_BASE_RELIC_EFFECT_CHAR_WIDTH = 40
+# labeled_chars を抽出した動画の高さ
+TEMPLATE_HEIGHT = 1080
+# 認識はパネル画像をこの高さ相当に拡大縮小してから行う(テンプレートも同じ倍率に揃える)
+WORK_HEIGHT = 1080
 
 RELIC_NAME_CHARS = 15
 RELIC_EFFECT_CHARS = 40
@@ -718,6 +745,110 @@ IGNORE_FULLSCORE_CHARS = [
     "来",
 ]
 
+# === プロファイル(--profile) ===
+class Profiler:
+    """フレームごとの処理区間(span)とカウンタを記録し、Chrome trace / Perfetto 形式の JSON に書き出す"""
+
+    enabled = True
+
+    def __init__(self):
+        self.started = time.perf_counter_ns()
+        self.events = []  # (区間名, pid, 開始ns, 所要ns, フレーム番号)
+        self.counters = Counter()
+
+    @contextmanager
+    def span(self, name, frame_idx=None):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.events.append((name, os.getpid(), start, time.perf_counter_ns() - start, frame_idx))
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def take(self):
+        """記録内容を返してリセット(ワーカーから集計する用)"""
+        data = (self.events, self.counters)
+        self.events, self.counters = [], Counter()
+        return data
+
+    def merge(self, data):
+        events, counters = data
+        self.events.extend(events)
+        self.counters.update(counters)
+
+    def export(self, path):
+        origin = min([self.started] + [e[2] for e in self.events])
+        main_pid = os.getpid()
+        trace = [
+            {"name": "process_name", "ph": "M", "pid": pid, "tid": pid,
+             "args": {"name": "analyze_relics" if pid == main_pid else f"worker {pid}"}}
+            for pid in sorted({e[1] for e in self.events} | {main_pid})
+        ]
+        for name, pid, start, duration, frame_idx in self.events:
+            trace.append({
+                "name": name, "cat": "relics", "ph": "X", "pid": pid, "tid": pid,
+                "ts": (start - origin) / 1000, "dur": duration / 1000, "args": {"frame": frame_idx},
+            })
+        trace.append({
+            "name": "counters", "ph": "C", "pid": main_pid, "tid": main_pid,
+            "ts": (time.perf_counter_ns() - origin) / 1000, "args": dict(self.counters),
+        })
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+    def report(self):
+        wall = (time.perf_counter_ns() - self.started) / 1e9
+        spans = {}
+        for name, _, _, duration, _ in self.events:
+            s = spans.setdefault(name, [0, 0, 0])
+            s[0] += 1
+            s[1] += duration
+            s[2] = max(s[2], duration)
+        print(f"Profile (wall {wall:.3f}s):")
+        print(f"  {'span':<14} {'count':>7} {'total ms':>10} {'mean ms':>9} {'max ms':>9}")
+        for name, (n, total, longest) in sorted(spans.items(), key=lambda item: -item[1][1]):
+            print(f"  {name:<14} {n:>7} {total / 1e6:>10.1f} {total / n / 1e6:>9.3f} {longest / 1e6:>9.3f}")
+        c = self.counters
+        for name in sorted(c):
+            print(f"  {name:<28} {c[name]:>10}")
+        if c["cells"]:
+            print(f"  {'templates_per_cell':<28} {c['templates_scanned'] / c['cells']:>10.1f}")
+
+
+class NullProfiler:
+    """プロファイル無効時に使う何もしない Profiler"""
+
+    enabled = False
+    _null_span = nullcontext()
+
+    def span(self, name, frame_idx=None):
+        return self._null_span
+
+    def count(self, name, n=1):
+        pass
+
+
+profiler = NullProfiler()
+
+
+def enable_profiler():
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+
+def take_profile():
+    """ワーカーの記録内容を親プロセスへ返す用(無効時は None)"""
+    return profiler.take() if profiler.enabled else None
+
+
+def merge_profile(data):
+    if data is not None:
+        profiler.merge(data)
+
+
 # === ROI 比率変換 ===
 def scaled_rect(x1, y1, x2, y2, fw, fh):
     sx = math.floor(fw * x1 / CALC_BASE_WIDTH)
@@ -726,13 +857,188 @@ def scaled_rect(x1, y1, x2, y2, fw, fh):
     ey = math.ceil(fh * y2 / CALC_BASE_HEIGHT)
     return {"x1": sx, "y1": sy, "x2": ex, "y2": ey}
 
-# === ROI内の平均差分を返す ===
-def calc_region_diff(prev_gray, gray, rect):
-    x1, y1, x2, y2 = rect["x1"], rect["y1"], rect["x2"], rect["y2"]
-    region_prev = prev_gray[y1:y2, x1:x2]
-    region_curr = gray[y1:y2, x1:x2]
-    diff = cv2.absdiff(region_prev, region_curr)
-    return np.mean(diff)
+# === ROI を基準位置からの相対座標に変換 ===
+def offset_rect(rect, origin):
+    ox, oy = origin["x1"], origin["y1"]
+    return {"x1": rect["x1"] - ox, "y1": rect["y1"] - oy, "x2": rect["x2"] - ox, "y2": rect["y2"] - oy}
+
+
+# === 遺物パネルの変化判定 ===
+class PanelGate:
+    """前回解析したフレームから rect 内が変化したかを判定し、変化時のみパネルのグレースケール画像を返す
+
+    mode="roi" は rect 内を stride 間隔で間引いたシグネチャで判定し、変化時のみ rect をフル解像度で変換する。
+    mode="frame" は rect 内をフル解像度でグレースケール化して平均差分で判定する。
+    どちらも前回の画像は rect の大きさだけ保持する。reuse_buffers=True なら変換先の配列を使い回す。
+    """
+
+    def __init__(self, rect, mode=DEFAULT_DIFF_GATE, stride=DIFF_GATE_STRIDE, threshold=FRAME_SKIP_DIFF_TH,
+                 reuse_buffers=False):
+        self.rect = rect
+        self.mode = mode
+        self.stride = stride
+        self.threshold = threshold
+        self.prev = None
+        self.reuse_buffers = reuse_buffers
+        # 次のシグネチャの書き込み先(prev と入れ替えながら使う)
+        self.spare = None
+        self.unchanged = False
+
+    def signature(self, frame):
+        x1, y1, x2, y2 = self.rect["x1"], self.rect["y1"], self.rect["x2"], self.rect["y2"]
+        step = 1 if self.mode == "frame" else self.stride
+        dst = self.spare if self.reuse_buffers else None
+        return cv2.cvtColor(frame[y1:y2:step, x1:x2:step], cv2.COLOR_BGR2GRAY, dst=dst)
+
+    def diff(self, prev, sig):
+        if self.mode == "frame":
+            return np.mean(cv2.absdiff(prev, sig))
+        return cv2.norm(prev, sig, cv2.NORM_L1) / sig.size
+
+    def feed(self, frame):
+        """(パネルのグレースケール画像 or 変化無しなら None, 差分値) を返す"""
+        sig = self.signature(frame)
+        diff_value = None if self.prev is None else self.diff(self.prev, sig)
+        self.unchanged = diff_value is not None and diff_value <= self.threshold
+        if self.unchanged:
+            self.spare = sig
+            return None, diff_value
+        self.spare, self.prev = self.prev, sig
+        return self._panel(frame, sig), diff_value
+
+    def panel(self, frame):
+        return cv2.cvtColor(crop_region(frame, self.rect, "panel"), cv2.COLOR_BGR2GRAY)
+
+    def _panel(self, frame, sig):
+        # mode="frame" ではシグネチャがそのままパネル画像になる(保持している配列は呼び出し側に渡さない)
+        return sig.copy() if self.mode == "frame" else self.panel(frame)
+
+    def steady(self):
+        """直前に feed したフレームが、最後に返したパネルから変化していないか"""
+        return self.unchanged
+
+    def prime(self, frame):
+        """frame を認識済みのフレームとして状態を設定する(途中から再開する用)"""
+        self.prev = self.signature(frame)
+        self.spare = None
+
+    def flush(self):
+        """動画の終端で呼ぶ。保留中のパネルがあれば返す"""
+        return None, None
+
+    def buffer_bytes(self):
+        return sum(a.nbytes for a in (self.prev, self.spare) if a is not None)
+
+
+class SettleGate(PanelGate):
+    """パネルが settle_frames フレーム連続で静止してから、遺物1件につき1回だけパネル画像を返す
+
+    状態は changing(静止の起点から変化) → settling(静止フレームを計測中) → stable(静止) と遷移する。
+    ゆっくりしたフェードも静止と誤判定しないよう、直前フレームではなく静止し始めたフレームと比較する。
+    前回認識した時点のシグネチャから threshold を超えて変化している場合のみ、stable になった時点で認識対象とする。
+    reuse_buffers=True なら、シグネチャは1つの配列に書き込み、静止の起点と認識時点のシグネチャはそれぞれの配列に複製して保持する。
+    """
+
+    def __init__(self, rect, settle_frames=DEFAULT_SETTLE_FRAMES, mode=DEFAULT_DIFF_GATE, stride=DIFF_GATE_STRIDE,
+                 threshold=FRAME_SKIP_DIFF_TH, settle_threshold=SETTLE_DIFF_TH, reuse_buffers=False):
+        super().__init__(rect, mode, stride, threshold, reuse_buffers)
+        self.settle_frames = settle_frames
+        self.settle_threshold = settle_threshold
+        self.state = "changing"
+        self.stable_count = 0
+        self.anchor = None
+        self.recognized_sig = None
+        self.last_frame = None
+
+    def _hold(self, held, sig):
+        """sig を保持する。配列を使い回す場合は held(前回の保持先)に複製する"""
+        if not self.reuse_buffers:
+            return sig
+        if held is None or held.shape != sig.shape:
+            return sig.copy()
+        np.copyto(held, sig)
+        return held
+
+    def _pending(self, sig):
+        return self.recognized_sig is None or cv2.norm(self.recognized_sig, sig, cv2.NORM_L1) / sig.size > self.threshold
+
+    def feed(self, frame):
+        sig = self.signature(frame)
+        diff_value = None if self.anchor is None else cv2.norm(self.anchor, sig, cv2.NORM_L1) / sig.size
+        self.prev = self.spare = sig
+        self.last_frame = frame
+
+        if diff_value is None or diff_value > self.settle_threshold:
+            self.state = "changing"
+            self.stable_count = 1
+            self.anchor = self._hold(self.anchor, sig)
+        else:
+            self.stable_count += 1
+            self.state = "stable" if self.stable_count >= self.settle_frames else "settling"
+
+        if self.state == "stable" and self._pending(sig):
+            self.recognized_sig = self._hold(self.recognized_sig, sig)
+            return self._panel(frame, sig), diff_value
+        return None, diff_value
+
+    def steady(self):
+        return self.state == "stable"
+
+    def prime(self, frame):
+        sig = self.signature(frame)
+        self.prev = self.spare = sig
+        self.anchor = self._hold(None, sig)
+        self.recognized_sig = self._hold(None, sig)
+        self.last_frame = frame
+        self.state = "stable"
+        self.stable_count = self.settle_frames
+
+    def flush(self):
+        # 静止しきる前に動画が終わった場合は最後のフレームで認識する
+        if self.last_frame is None or not self._pending(self.prev):
+            return None, None
+        self.recognized_sig = self._hold(self.recognized_sig, self.prev)
+        return self._panel(self.last_frame, self.prev), None
+
+    def buffer_bytes(self):
+        return sum(a.nbytes for a in (self.spare, self.anchor, self.recognized_sig) if a is not None)
+
+
+def create_gate(rect, diff_gate=DEFAULT_DIFF_GATE, settle_frames=DEFAULT_SETTLE_FRAMES, reuse_buffers=False):
+    """settle_frames が 1 以上なら SettleGate、0 なら変化したフレームを毎回返す PanelGate"""
+    if settle_frames > 0:
+        return SettleGate(rect, settle_frames, diff_gate, reuse_buffers=reuse_buffers)
+    return PanelGate(rect, diff_gate, reuse_buffers=reuse_buffers)
+
+
+# === バッファの使い回し(--buffer-pool) ===
+def enable_buffer_pool(cap, log=print):
+    """フレーム供給元がバッファの使い回しに対応していれば有効にする(cv2.VideoCapture は非対応)"""
+    enable = getattr(cap, "enable_buffer_pool", None)
+    if enable is None:
+        log("⚠️ このフレーム供給元はバッファの使い回しに対応していません")
+        return False
+    enable()
+    return True
+
+
+def peak_rss_bytes():
+    """プロセスの最大常駐メモリ(取得できない環境では None)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def report_memory(cap, gate, log=print):
+    """使い回しているバッファの大きさと最大常駐メモリを表示する"""
+    frame_bytes = cap.buffer_bytes() if hasattr(cap, "buffer_bytes") else 0
+    peak = peak_rss_bytes()
+    log(
+        f"Buffers: frame={frame_bytes / 2**20:.1f}MB, gate={gate.buffer_bytes() / 2**20:.2f}MB"
+        + (f", peak RSS={peak / 2**20:.0f}MB" if peak is not None else "")
+    )
 
 # === 前処理 ===
 def preprocess(img):
@@ -742,6 +1048,7 @@ def preprocess(img):
 
 # === 類似度計算 ===
 def calc_similarity(img_gray, template_gray):
+    profiler.count("match_template_calls")
     try:
         res = cv2.matchTemplate(img_gray, template_gray, cv2.TM_CCOEFF_NORMED)
         return float(np.max(res))
@@ -769,8 +1076,537 @@ def match_best_char(char_img_gray, labeled_dict, score_th=0.5):
     return best_char, best_score
 
 
+# === 文字照合バックエンド ===
+class LoopMatcher:
+    """match_best_char を1文字ずつ呼び出す参照実装"""
+
+    def __init__(self, labeled_dict):
+        self.labeled_dict = labeled_dict
+        self.n_templates = sum(len(samples) for samples in labeled_dict.values())
+
+    def match_cells(self, cells, score_th=0.5):
+        # recognize_text の打ち切りに合わせて遅延評価する
+        for cell in cells:
+            profiler.count("cells")
+            profiler.count("templates_scanned", self.n_templates)
+            yield match_best_char(cell, self.labeled_dict, score_th)
+
+
+class BatchMatcher:
+    """テンプレート群を連続配列にまとめ、1行分の全セルを行列演算でまとめて照合する
+
+    スコアは TM_CCOEFF_NORMED と同じ正規化相互相関。上位候補・閾値付近・満点付近のみ
+    calc_similarity で再計算し、match_best_char と同じ文字/スコアを返す。
+    """
+
+    # sliding window 展開時に一度に扱う最大行数(メモリ使用量の上限)
+    MAX_WINDOW_ROWS = 8192
+    # 行列演算(float32)の誤差を吸収して再計算する範囲
+    REFINE_EPS = 1e-4
+
+    def __init__(self, labeled_dict):
+        labels, tmpls = [], []
+        for ch, samples in labeled_dict.items():
+            ch = ch.replace("\r", "")
+            for tmpl in samples:
+                labels.append(ch)
+                tmpls.append(tmpl)
+        self.labels = labels
+        self.templates = tmpls
+        self.ignore_fullscore = np.array([ch in IGNORE_FULLSCORE_CHARS for ch in labels], dtype=bool)
+
+        # テンプレートサイズごとに 平均0・ノルム1 に正規化した行列をまとめる
+        by_shape = {}
+        for i, tmpl in enumerate(tmpls):
+            by_shape.setdefault(tmpl.shape, []).append(i)
+        self.groups = []
+        for shape, idx in by_shape.items():
+            stack = np.stack([tmpls[i] for i in idx])
+            self.groups.append((shape, np.array(idx), stack, _normalize_rows(stack.reshape(len(idx), -1))))
+        self._swapped_cache = {}
+
+    def _swapped_windows(self, group_no, cell_shape):
+        # テンプレートの方が大きい場合、matchTemplate は画像とテンプレートを入れ替えて照合する
+        key = (group_no, cell_shape)
+        if key not in self._swapped_cache:
+            (th, tw), tmpl_idx, stack, _ = self.groups[group_no]
+            ch, cw = cell_shape
+            windows = np.lib.stride_tricks.sliding_window_view(stack, cell_shape, axis=(1, 2))
+            n_pos = (th - ch + 1) * (tw - cw + 1)
+            self._swapped_cache[key] = (n_pos, _normalize_rows(windows.reshape(-1, ch * cw)))
+        return self._swapped_cache[key]
+
+    def score_cells(self, cells):
+        """cells × テンプレート の近似スコア行列(float32)を返す。照合不可のサイズは 0.0"""
+        return self._score_cells(cells)[0]
+
+    def _score_cells(self, cells):
+        # 無地による 1.0 は OpenCV と同じ確定値なので exact として返す
+        scores = np.zeros((len(cells), len(self.labels)), dtype=np.float32)
+        exact = np.zeros(scores.shape, dtype=bool)
+        by_shape = {}
+        for c, cell in enumerate(cells):
+            if cell.size > 0:
+                by_shape.setdefault(cell.shape, []).append(c)
+
+        for cell_shape, cell_idx in by_shape.items():
+            ch, cw = cell_shape
+            stack = np.stack([cells[c] for c in cell_idx])
+            constant_cell = np.ptp(stack.reshape(len(cell_idx), -1), axis=1) == 0
+            for group_no, ((th, tw), tmpl_idx, _, tmpl_mat) in enumerate(self.groups):
+                if th <= ch and tw <= cw:
+                    n_pos = (ch - th + 1) * (cw - tw + 1)
+                    step = max(1, self.MAX_WINDOW_ROWS // n_pos)
+                    for start in range(0, len(cell_idx), step):
+                        part = stack[start:start + step]
+                        windows = np.lib.stride_tricks.sliding_window_view(part, (th, tw), axis=(1, 2))
+                        res = _normalize_rows(windows.reshape(-1, th * tw)) @ tmpl_mat.T
+                        best = res.reshape(len(part), n_pos, -1).max(axis=1)
+                        # 無地のテンプレートは OpenCV では常に 1.0
+                        blank = ~tmpl_mat.any(axis=1)
+                        best[:, blank] = 1.0
+                        rows = cell_idx[start:start + step]
+                        scores[np.ix_(rows, tmpl_idx)] = best
+                        exact[np.ix_(rows, tmpl_idx[blank])] = True
+                elif th >= ch and tw >= cw:
+                    n_pos, win_mat = self._swapped_windows(group_no, cell_shape)
+                    res = _normalize_rows(stack.reshape(len(cell_idx), -1)) @ win_mat.T
+                    best = res.reshape(len(cell_idx), len(tmpl_idx), n_pos).max(axis=2)
+                    best[constant_cell] = 1.0
+                    scores[np.ix_(cell_idx, tmpl_idx)] = best
+                    exact[np.ix_(np.array(cell_idx)[constant_cell], tmpl_idx)] = True
+        return scores, exact
+
+    def _refine(self, cell, row, exact, cols):
+        for j in cols:
+            if not exact[j]:
+                row[j] = calc_similarity(cell, self.templates[j])
+                exact[j] = True
+
+    def match_cells(self, cells, score_th=0.5):
+        results = []
+        scores, exact_all = self._score_cells(cells)
+        profiler.count("cells", len(cells))
+        profiler.count("templates_scanned", scores.size)
+        for cell, row, exact in zip(cells, scores, exact_all):
+            row = row.astype(np.float64)
+            eps = self.REFINE_EPS
+            # 満点除外ルール/閾値の判定がぶれないよう境界付近は正確な値に置き換える
+            self._refine(cell, row, exact, np.flatnonzero((row >= 1.0 - eps) | (np.abs(row - score_th) < eps)))
+            while True:
+                valid = (row >= score_th) & ~((row == 1.0) & self.ignore_fullscore)
+                if not valid.any():
+                    results.append((None, 0.0))
+                    break
+                top = np.flatnonzero(valid & (row >= row[valid].max() - eps) & ~exact)
+                if len(top) == 0:
+                    best = int(np.argmax(np.where(valid, row, -1.0)))
+                    results.append((self.labels[best], float(row[best])))
+                    break
+                self._refine(cell, row, exact, top)
+        return results
+
+
+def _normalize_rows(mat):
+    """各行を 平均0・ノルム1 に正規化(無地の行は 0 のまま)した float32 行列を返す"""
+    mat = mat.astype(np.float64)
+    mat -= mat.mean(axis=1, keepdims=True)
+    norm = np.sqrt(np.einsum("ij,ij->i", mat, mat))
+    np.divide(mat, norm[:, None], out=mat, where=norm[:, None] > 0)
+    return mat.astype(np.float32)
+
+
+class CascadeMatcher:
+    """縮小したセル画像(シグネチャ)の相関で候補を k 件に絞り、その k 件だけを calc_similarity で照合する
+
+    1段目は各テンプレートを SIGNATURE_SCALE 分の1に縮小した画像との正規化相関を行列演算でまとめて求める。
+    2段目は match_best_char と同じ閾値・満点除外ルールで上位 k 件を照合する。
+    無地のセルは縮小しても候補を絞れないため、BatchMatcher で全テンプレートと照合する。
+    無地のセルのスコアは画素値によらずサイズだけで決まるので、結果はサイズごとに使い回す。
+    テンプレートより大きいセル(位置を探させる余白付きのセル)も縮小画像では比べられないため BatchMatcher に任せる。
+    満点除外ルールで候補を外したセルと、上位 k 件の最良スコアが score_th + FALLBACK_MARGIN に届かないセルは、
+    最良のテンプレートが上位 k 件の外にあることがあるため BatchMatcher で照合し直す。
+    """
+
+    SIGNATURE_SCALE = 4
+    # 720p・4K から認識解像度に拡大縮小したセルは縮小画像の相関の順位がぶれ、k=32 でも最良のテンプレートを外すことがある。
+    # 外したセルの上位 k 件の最良スコアは score_th + 0.25 未満だった(サンプル動画の 720p/1080p/1440p/4K の全セル)
+    FALLBACK_MARGIN = 0.25
+
+    def __init__(self, labeled_dict, k=None):
+        labels, tmpls = [], []
+        for ch, samples in labeled_dict.items():
+            ch = ch.replace("\r", "")
+            for tmpl in samples:
+                labels.append(ch)
+                tmpls.append(tmpl)
+        self.full_matcher = BatchMatcher(labeled_dict)
+        self.blank_results = {}
+        self.labels = labels
+        self.templates = tmpls
+        self.k = min(k or DEFAULT_CASCADE_K, len(tmpls))
+        h = max((t.shape[0] for t in tmpls), default=1)
+        w = max((t.shape[1] for t in tmpls), default=1)
+        self.template_size = (h, w)
+        self.signature_size = (max(1, math.ceil(w / self.SIGNATURE_SCALE)), max(1, math.ceil(h / self.SIGNATURE_SCALE)))
+        self.signatures = self._signatures(tmpls)
+
+    def _signatures(self, imgs):
+        if not imgs:
+            return np.zeros((0, self.signature_size[0] * self.signature_size[1]), dtype=np.float32)
+        return _normalize_rows(np.stack([
+            cv2.resize(np.ascontiguousarray(img), self.signature_size, interpolation=cv2.INTER_AREA).ravel() for img in imgs
+        ]))
+
+    def candidates(self, cells):
+        """セルごとに、シグネチャの相関が高い順の k 件のテンプレート番号(絞り込めないセルは None)"""
+        h, w = self.template_size
+        textured = [
+            c for c, cell in enumerate(cells)
+            if cell.size > 0 and cell.min() != cell.max() and cell.shape[0] <= h and cell.shape[1] <= w
+        ]
+        result = [None] * len(cells)
+        if textured and self.k:
+            scores = self._signatures([cells[c] for c in textured]) @ self.signatures.T
+            top = np.argpartition(-scores, self.k - 1, axis=1)[:, :self.k]
+            for c, idx in zip(textured, top):
+                result[c] = np.sort(idx)
+        return result
+
+    def match_cells(self, cells, score_th=0.5):
+        # recognize_text の打ち切りに合わせて2段目は遅延評価する
+        for cell, idx in zip(cells, self.candidates(cells)):
+            if idx is None:
+                if cell.size > 0 and cell.min() != cell.max():
+                    yield self.full_matcher.match_cells([cell], score_th)[0]
+                    continue
+                key = (cell.shape, score_th)
+                if key not in self.blank_results:
+                    self.blank_results[key] = self.full_matcher.match_cells([cell], score_th)[0]
+                yield self.blank_results[key]
+                continue
+            profiler.count("cells")
+            profiler.count("templates_scanned", len(idx))
+            best_char, best_score = None, 0.0
+            ignored = False
+            # テンプレートの並び順で照合し、同点時も match_best_char と同じ文字を選ぶ
+            for j in idx:
+                score = calc_similarity(cell, self.templates[j])
+                if score == 1.0 and self.labels[j] in IGNORE_FULLSCORE_CHARS:
+                    ignored = True
+                    continue
+                if score >= score_th and score > best_score:
+                    best_char, best_score = self.labels[j], score
+            if ignored or best_score < score_th + self.FALLBACK_MARGIN:
+                profiler.count("cascade_fallbacks")
+                yield self.full_matcher.match_cells([cell], score_th)[0]
+                continue
+            yield best_char, best_score
+
+
+def _pack_bits(mask):
+    """(n, 画素数) の bool 配列を (n, 語数) の uint64 ビット列に詰める(末尾は 0 で埋める)"""
+    packed = np.packbits(mask, axis=1)
+    pad = -packed.shape[1] % 8
+    if pad:
+        packed = np.pad(packed, ((0, 0), (0, pad)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def _phi_from_hamming(dist, count_a, count_b, n_pixels):
+    """ハミング距離と双方の文字画素数から、二値画像どうしの TM_CCOEFF_NORMED(φ係数)を求める(無地は 0)"""
+    count_a = count_a.astype(np.int64)
+    count_b = count_b.astype(np.int64)
+    both = (count_a + count_b - dist) // 2
+    num = (n_pixels * both - count_a * count_b).astype(np.float64)
+    den = np.sqrt((count_a * (n_pixels - count_a)).astype(np.float64)) * np.sqrt((count_b * (n_pixels - count_b)).astype(np.float64))
+    return np.divide(num, den, out=np.zeros(num.shape), where=den > 0)
+
+
+class BitsetMatcher:
+    """二値化したセルとテンプレートをビット列に詰め、XOR と popcount のハミング距離でまとめて照合する
+
+    位置は matchTemplate と同じくサイズ差の範囲だけずらす。ハミング距離は文字画素数と合わせて
+    φ係数(二値画像どうしの TM_CCOEFF_NORMED と同じ値)に換算する。平均化で中間調を含むテンプレートは
+    二値化で失われる分を、テンプレートどうしの照合から求めたテンプレートごとの1次式で相関のスケールに補正する。
+    matchTemplate は画素が一致する窓で 1.0(丸め誤差で 0.99999… になることもある)を返すため、ハミング距離 0 の組は
+    calc_similarity で求め直す。それ以外の一致は 1.0 未満に抑え(無地のテンプレート、入れ替え時は無地のセルは 1.0)、
+    score_th と IGNORE_FULLSCORE_CHARS を match_best_char と同じ意味で使えるようにする。
+    補正した値は正確な相関から数% ずれ、1080p 以外の動画では1位と2位が入れ替わることがあるため、
+    近似スコアの1位(score_th 未満なら score_th)から REFINE_GAP 以内の中間調のテンプレートだけを calc_similarity で照合し直して決める。
+    φ係数は二値のセルを前提にするため、中間調を含むセル(テンプレート自身など)は全テンプレートを calc_similarity で照合する。
+    """
+
+    # XOR の中間配列(uint64)の最大要素数
+    MAX_XOR_WORDS = 1 << 21
+    # 満点未満に抑えるときの上限
+    BELOW_FULLSCORE = np.nextafter(1.0, 0.0)
+    # 近似スコアで照合し直す候補の幅(サンプル動画を 720p/1080p/1440p/4K で読み込んだ全セルで、
+    # 正確なスコアで1位のテンプレートは近似スコアの1位から 0.07 以内。照合し直す候補は1セルあたり平均 1〜2 件)
+    REFINE_GAP = 0.15
+
+    def __init__(self, labeled_dict):
+        labels, tmpls = [], []
+        for ch, samples in labeled_dict.items():
+            ch = ch.replace("\r", "")
+            for tmpl in samples:
+                labels.append(ch)
+                tmpls.append(tmpl)
+        self.labels = labels
+        self.templates = tmpls
+        self.ignore_fullscore = np.array([ch in IGNORE_FULLSCORE_CHARS for ch in labels], dtype=bool)
+        self.graded = np.array([np.count_nonzero((t > 0) & (t < 255)) > 0 for t in tmpls], dtype=bool)
+
+        # テンプレートサイズごとに 文字の画素のマスク・ビット列・文字画素数・無地か をまとめる
+        # (preprocess は THRESH_BINARY_INV で二値化するため、文字の画素は 0、背景は 255)
+        by_shape = {}
+        for i, tmpl in enumerate(tmpls):
+            by_shape.setdefault(tmpl.shape, []).append(i)
+        self.groups = []
+        for shape, idx in by_shape.items():
+            strokes = np.stack([tmpls[i] <= 127 for i in idx]).reshape(len(idx), -1)
+            blank = np.array([tmpls[i].min() == tmpls[i].max() for i in idx])
+            self.groups.append((shape, np.array(idx), strokes, _pack_bits(strokes), np.count_nonzero(strokes, axis=1), blank))
+        self.calibration = self._fit_calibration()
+        self._swapped_cache = {}
+
+    def _fit_calibration(self):
+        """中間調のテンプレートごとに φ係数 → 相関 の1次式の (傾き, 切片) を求める(二値のテンプレートは (1, 0))
+
+        同じサイズの二値化したテンプレート群をセルの代わりにして、元のテンプレートとの相関と φ係数を最小二乗で合わせる。
+        """
+        slopes = np.ones(len(self.templates))
+        intercepts = np.zeros(len(self.templates))
+        for _, idx, strokes, packed, stroke_count, _ in self.groups:
+            graded = self.graded[idx]
+            if not graded.any() or len(idx) < 2:
+                continue
+            dist = np.bitwise_count(packed[:, None, :] ^ packed[None, graded, :]).sum(axis=2, dtype=np.int64)
+            phi = _phi_from_hamming(dist, stroke_count[:, None], stroke_count[None, graded], strokes.shape[1])
+            probes = _normalize_rows(np.where(strokes, 0, 255))
+            corr = probes @ _normalize_rows(np.stack([self.templates[i] for i in idx[graded]]).reshape(graded.sum(), -1)).T
+            dx = phi - phi.mean(axis=0)
+            var = np.einsum("ij,ij->j", dx, dx)
+            slope = np.divide(np.einsum("ij,ij->j", dx, corr - corr.mean(axis=0)), var, out=np.ones(len(var)), where=var > 0)
+            slopes[idx[graded]] = slope
+            intercepts[idx[graded]] = np.where(var > 0, corr.mean(axis=0) - slope * phi.mean(axis=0), 0.0)
+        return slopes, intercepts
+
+    def _swapped_windows(self, group_no, cell_shape):
+        # テンプレートの方が大きい場合は、matchTemplate と同じくテンプレート側の窓をセルと照合する
+        key = (group_no, cell_shape)
+        if key not in self._swapped_cache:
+            (th, tw), idx, strokes, _, _, _ = self.groups[group_no]
+            ch, cw = cell_shape
+            windows = np.lib.stride_tricks.sliding_window_view(strokes.reshape(len(idx), th, tw), cell_shape, axis=(1, 2))
+            n_pos = (th - ch + 1) * (tw - cw + 1)
+            windows = windows.reshape(-1, ch * cw)
+            self._swapped_cache[key] = (n_pos, _pack_bits(windows), np.count_nonzero(windows, axis=1))
+        return self._swapped_cache[key]
+
+    def _hamming(self, a, b):
+        """a(n, 語数) と b(m, 語数) の全組のハミング距離 (n, m) を、中間配列の大きさを抑えて求める"""
+        dist = np.empty((len(a), len(b)), dtype=np.int64)
+        step = max(1, self.MAX_XOR_WORDS // max(1, b.size))
+        for start in range(0, len(a), step):
+            dist[start:start + step] = np.bitwise_count(a[start:start + step, None, :] ^ b[None, :, :]).sum(axis=2, dtype=np.int64)
+        return dist
+
+    def score_cells(self, cells):
+        """cells × テンプレート のスコア行列を返す。照合不可のサイズは 0.0"""
+        scores = np.zeros((len(cells), len(self.labels)))
+        by_shape = {}
+        for c, cell in enumerate(cells):
+            if cell.size > 0:
+                by_shape.setdefault(cell.shape, []).append(c)
+
+        for cell_shape, cell_idx in by_shape.items():
+            ch, cw = cell_shape
+            strokes = np.stack([cells[c] <= 127 for c in cell_idx])
+            constant_cell = np.array([cells[c].min() == cells[c].max() for c in cell_idx])
+            for group_no, ((th, tw), tmpl_idx, _, packed, stroke_count, blank) in enumerate(self.groups):
+                if th <= ch and tw <= cw:
+                    n_pos = (ch - th + 1) * (cw - tw + 1)
+                    windows = np.lib.stride_tricks.sliding_window_view(strokes, (th, tw), axis=(1, 2)).reshape(-1, th * tw)
+                    dist = self._hamming(_pack_bits(windows), packed)
+                    phi = _phi_from_hamming(dist, np.count_nonzero(windows, axis=1)[:, None], stroke_count[None, :], th * tw)
+                    best = phi.reshape(len(cell_idx), n_pos, -1).max(axis=1)
+                    exact = (dist.reshape(len(cell_idx), n_pos, -1) == 0).any(axis=1)
+                    # 無地のテンプレートは OpenCV では常に 1.0
+                    full = np.broadcast_to(blank, best.shape)
+                elif th >= ch and tw >= cw:
+                    n_pos, win_packed, win_strokes = self._swapped_windows(group_no, cell_shape)
+                    cell_strokes = strokes.reshape(len(cell_idx), -1)
+                    dist = self._hamming(_pack_bits(cell_strokes), win_packed)
+                    phi = _phi_from_hamming(dist, np.count_nonzero(cell_strokes, axis=1)[:, None], win_strokes[None, :], ch * cw)
+                    best = phi.reshape(len(cell_idx), len(tmpl_idx), n_pos).max(axis=2)
+                    exact = (dist.reshape(len(cell_idx), len(tmpl_idx), n_pos) == 0).any(axis=2)
+                    full = np.broadcast_to(constant_cell[:, None], best.shape)
+                else:
+                    continue
+                slopes, intercepts = self.calibration
+                best = slopes[tmpl_idx] * best + intercepts[tmpl_idx]
+                best = np.where(full, 1.0, np.minimum(best, self.BELOW_FULLSCORE))
+                for i, k in zip(*np.nonzero(exact & ~full)):
+                    best[i, k] = calc_similarity(cells[cell_idx[i]], self.templates[tmpl_idx[k]])
+                scores[np.ix_(cell_idx, tmpl_idx)] = best
+        return scores
+
+    def match_cells(self, cells, score_th=0.5):
+        if not cells:
+            return []
+        scores = self.score_cells(cells)
+        profiler.count("cells", len(cells))
+        profiler.count("templates_scanned", scores.size)
+        allowed = ~((scores == 1.0) & self.ignore_fullscore)
+        limits = np.maximum(np.where(allowed, scores, -1.0).max(axis=1), score_th) - self.REFINE_GAP
+        results = []
+        for cell, row, ok, limit in zip(cells, scores, allowed, limits):
+            if np.count_nonzero((cell > 0) & (cell < 255)):
+                # 中間調のセル(preprocess で二値化していない画像)は二値化で失われる分を補正できないので全テンプレートと照合する
+                row = np.array([calc_similarity(cell, tmpl) for tmpl in self.templates])
+            else:
+                # 二値のテンプレートの φ係数は正確な相関と同じ値なので、補正した中間調のテンプレートだけを照合し直す
+                for j in np.flatnonzero(ok & self.graded & (row >= limit)):
+                    row[j] = calc_similarity(cell, self.templates[j])
+            valid = (row >= score_th) & ~((row == 1.0) & self.ignore_fullscore)
+            if not valid.any():
+                results.append((None, 0.0))
+                continue
+            # 同点時は match_best_char と同じくテンプレートの並び順で先の文字を選ぶ
+            j = int(np.argmax(np.where(valid, row, -1.0)))
+            results.append((self.labels[j], float(row[j])))
+        return results
+
+
+MATCHER_BACKENDS = {
+    "batch": BatchMatcher,
+    "bitset": BitsetMatcher,
+    "cascade": CascadeMatcher,
+    "loop": LoopMatcher,
+}
+DEFAULT_MATCHER_BACKEND = "batch"
+# cascade バックエンドで calc_similarity による照合に残す候補数
+DEFAULT_CASCADE_K = 4
+
+
+# === 効果文の語彙に沿った文字照合 ===
+DEFAULT_DECODER = "scan"
+# 語彙から絞り込んだ候補の照合で、このスコア以上なら残りの候補を見ずに確定
+TRIE_ACCEPT_SCORE = 0.9
+# 絞り込んだ候補の最良スコアがこれ未満なら全テンプレートで照合し直す
+TRIE_MIN_SCORE = 0.7
+TRIE_SEPARATORS = "|｜"
+
+
+class CatalogTrie:
+    """語彙の各文字位置をカーソルとして持ち、次に来うる文字を絞り込む
+
+    カーソルは (語彙数, 最大文字数+1) の bool 配列で、全接尾辞の trie をたどるのと同じ働きをする。
+    """
+
+    def __init__(self, texts):
+        texts = list(dict.fromkeys(texts))
+        self.codes = np.full((len(texts), max(len(t) for t in texts) + 1), -1, dtype=np.int32)
+        for i, text in enumerate(texts):
+            self.codes[i, :len(text)] = [ord(ch) for ch in text]
+        self.starts = np.zeros(self.codes.shape, dtype=bool)
+        self.starts[:, 0] = True
+        self.anywhere = self.codes >= 0
+
+    def next_chars(self, cursors):
+        """カーソルの次に来うる文字を、語彙内の出現数が多い順に返す"""
+        codes = self.codes[cursors]
+        uniq, counts = np.unique(codes[codes >= 0], return_counts=True)
+        return [chr(c) for c in uniq[np.argsort(-counts, kind="stable")]]
+
+    def advance(self, cursors, ch):
+        moved = np.zeros_like(cursors)
+        moved[:, 1:] = cursors[:, :-1] & (self.codes[:, :-1] == ord(ch))
+        return moved
+
+    def resync(self, ch):
+        """語彙外から復帰する。ch の直後の位置すべてをカーソルにする(語彙に無い文字なら None)"""
+        cursors = self.advance(self.anywhere, ch)
+        return cursors if cursors.any() else None
+
+
+class TrieDecoder:
+    """語彙(効果文/デメリット)をたどり、次に来うる文字のテンプレートだけを照合する
+
+    行頭は語彙の先頭、見つからなければ語彙の途中(2行目の続き)から候補を作る。
+    語彙外の文字・区切りの「|」・空白は base_matcher で全テンプレートを照合し、「|」の後は語彙の先頭に戻る。
+    """
+
+    def __init__(self, labeled_dict, base_matcher, catalog=None):
+        self.base_matcher = base_matcher
+        self.samples = {}
+        for ch, samples in labeled_dict.items():
+            self.samples.setdefault(ch.replace("\r", ""), []).extend(samples)
+        self.trie = CatalogTrie(catalog or EFFECT_LIST + DISADVANTAGE_EFFECTS + ["※適用可能な武器種のみ"])
+        self.stats = Counter()
+
+    def _match_among(self, cell, chars, score_th):
+        best_char, best_score = None, 0.0
+        for ch in chars:
+            for tmpl in self.samples.get(ch, ()):
+                score = calc_similarity(cell, tmpl)
+                self.stats["template_calls"] += 1
+                profiler.count("templates_scanned")
+                if score < score_th or (score == 1.0 and ch in IGNORE_FULLSCORE_CHARS):
+                    continue
+                if score > best_score:
+                    best_char, best_score = ch, score
+            if best_score >= TRIE_ACCEPT_SCORE:
+                break
+        return best_char, best_score
+
+    def match_cells(self, cells, score_th=0.5):
+        trie = self.trie
+        cursors = trie.starts
+        for cell in cells:
+            self.stats["cells"] += 1
+            ch, score, source = None, 0.0, None
+            # 空白セル(行末・空行)は語彙で絞り込めないので全テンプレート照合に任せる
+            if cursors is not None and cell.size > 0 and cell.min() != cell.max():
+                tried = trie.next_chars(cursors)
+                ch, score = self._match_among(cell, tried, score_th)
+                source = cursors
+                if score < TRIE_MIN_SCORE and cursors is trie.starts:
+                    # 行頭で見つからない場合は折り返した2行目とみなして語彙の途中から探す
+                    rest = [c for c in trie.next_chars(trie.anywhere) if c not in set(tried)]
+                    ch2, score2 = self._match_among(cell, rest, score_th)
+                    if score2 > score:
+                        ch, score, source = ch2, score2, trie.anywhere
+
+            if score >= TRIE_MIN_SCORE:
+                # 全テンプレート照合に回したセルは base_matcher 側で数える
+                profiler.count("cells")
+                cursors = trie.advance(source, ch)
+                if not cursors.any():
+                    cursors = None
+            else:
+                self.stats["full_scans"] += 1
+                ch, score = next(iter(self.base_matcher.match_cells([cell], score_th)))
+                if ch is not None:
+                    cursors = trie.starts if ch in TRIE_SEPARATORS else trie.resync(ch)
+            yield ch, score
+
+
+def create_matchers(templates, backend=DEFAULT_MATCHER_BACKEND, decoder=DEFAULT_DECODER, cascade_k=DEFAULT_CASCADE_K):
+    """templates の種類(name/effect)ごとに照合バックエンドを生成(cascade_k は cascade バックエンドの候補数)"""
+    matcher_cls = MATCHER_BACKENDS[backend]
+    if backend == "cascade":
+        matchers = {kind: matcher_cls(labeled_dict, cascade_k) for kind, labeled_dict in templates.items()}
+    else:
+        matchers = {kind: matcher_cls(labeled_dict) for kind, labeled_dict in templates.items()}
+    if decoder == "trie" and "effect" in matchers:
+        matchers["effect"] = TrieDecoder(templates["effect"], matchers["effect"])
+    return matchers
+
+
 # === labeled_chars 読み込み ===
-def load_labeled_templates(average=True):
+def load_labeled_templates(average=True, work_height=WORK_HEIGHT):
     templates = {"name": {}, "effect": {}}
     for kind, base_dir in [("name", NAME_DIR), ("effect", EFFECT_DIR)]:
         if not os.path.isdir(base_dir):
@@ -801,42 +1637,677 @@ def load_labeled_templates(average=True):
             else:
                 templates[kind][label] = imgs
 
+    if work_height != TEMPLATE_HEIGHT:
+        templates = scale_templates(templates, work_height / TEMPLATE_HEIGHT)
+    return templates
+
+
+def scale_templates(templates, factor):
+    """テンプレートを factor 倍に拡大縮小する(認識する解像度に揃える)
+
+    照合する行画像は二値化済みなので、拡大縮小後のテンプレートも二値化し直す。
+    """
+    interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_LINEAR
+
+    def scale(t):
+        size = (max(1, round(t.shape[1] * factor)), max(1, round(t.shape[0] * factor)))
+        return cv2.threshold(cv2.resize(t, size, interpolation=interpolation), 127, 255, cv2.THRESH_BINARY)[1]
+
+    return {
+        kind: {label: [scale(t) for t in samples] for label, samples in labeled_dict.items()}
+        for kind, labeled_dict in templates.items()
+    }
+
+
+# === テンプレートバンクのキャッシュ ===
+# 前処理済みテンプレートを1ファイルにまとめ、次回以降は memmap で読み込む
+# Docker イメージではビルド時に作ったキャッシュを labeled_chars のマウントで隠さないよう別の場所を指定する
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", os.path.join(LABELED_BASE, ".cache"))
+TEMPLATE_BANK_MAGIC = b"ENRBANK1"
+# 前処理(preprocess/平均化)の内容を変えたら更新する
+TEMPLATE_BANK_VERSION = 1
+
+
+def calc_template_bank_key(average=True, work_height=WORK_HEIGHT):
+    """labeled_chars の内容と前処理パラメータから キャッシュキー(sha256) を求める
+
+    更新日時ではなく PNG の内容で求める。Docker イメージに COPY した labeled_chars と実行時にマウントする
+    labeled_chars は中身が同じでも更新日時が揃う保証がなく、ビルド時のキャッシュを使えなくなるため。
+    PNG は数百件・数MB なので、読み込みとハッシュは起動ごとに数ms で済む。
+    """
+    h = hashlib.sha256()
+    h.update(f"v{TEMPLATE_BANK_VERSION}:average={average}:height={TEMPLATE_HEIGHT}->{work_height}".encode())
+    for kind, base_dir in [("name", NAME_DIR), ("effect", EFFECT_DIR)]:
+        if not os.path.isdir(base_dir):
+            continue
+        for fname in sorted(os.listdir(base_dir)):
+            if not fname.endswith(".png"):
+                continue
+            with open(os.path.join(base_dir, fname), "rb") as f:
+                data = f.read()
+            h.update(f"\0{kind}/{fname}\0{len(data)}\0".encode())
+            h.update(data)
+    return h.hexdigest()
+
+
+def save_template_bank(templates, path, key):
+    """テンプレートを (ラベル表 + パディング済み配列) の単一バイナリとして保存"""
+    header = {"key": key, "kinds": {}}
+    arrays = []
+    offset = 0
+    for kind, labeled_dict in templates.items():
+        entries = [(label, tmpl) for label, samples in labeled_dict.items() for tmpl in samples]
+        h_max = max((t.shape[0] for _, t in entries), default=0)
+        w_max = max((t.shape[1] for _, t in entries), default=0)
+        padded = np.zeros((len(entries), h_max, w_max), dtype=np.uint8)
+        for i, (_, tmpl) in enumerate(entries):
+            padded[i, :tmpl.shape[0], :tmpl.shape[1]] = tmpl
+        header["kinds"][kind] = {
+            "labels": [label for label, _ in entries],
+            "shapes": [list(t.shape) for _, t in entries],
+            "array_shape": list(padded.shape),
+            "offset": offset,
+        }
+        arrays.append(padded)
+        offset += padded.nbytes
+
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    data_start = len(TEMPLATE_BANK_MAGIC) + 8 + len(header_bytes)
+    padding = -data_start % 64
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(TEMPLATE_BANK_MAGIC)
+        f.write((len(header_bytes) + padding).to_bytes(8, "little"))
+        f.write(header_bytes + b" " * padding)
+        for padded in arrays:
+            f.write(padded.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_template_bank_file(path, key=None):
+    """save_template_bank で保存したファイルを memmap で読み込む。不一致・破損時は None"""
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(TEMPLATE_BANK_MAGIC)) != TEMPLATE_BANK_MAGIC:
+                return None
+            header_len = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_len).decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+    if key is not None and header.get("key") != key:
+        return None
+
+    data_start = len(TEMPLATE_BANK_MAGIC) + 8 + header_len
+    templates = {}
+    for kind, info in header["kinds"].items():
+        templates[kind] = {}
+        if info["array_shape"][0] == 0:
+            continue
+        padded = np.memmap(path, dtype=np.uint8, mode="r", offset=data_start + info["offset"], shape=tuple(info["array_shape"]))
+        for i, (label, (h, w)) in enumerate(zip(info["labels"], info["shapes"])):
+            templates[kind].setdefault(label, []).append(padded[i, :h, :w])
+    return templates
+
+
+def load_template_bank(average=True, cache_dir=TEMPLATE_CACHE_DIR, work_height=WORK_HEIGHT):
+    """キャッシュがあれば memmap で読み込み、無ければ load_labeled_templates で作成して保存
+
+    キャッシュは認識する解像度(work_height)ごとに拡大縮小済みのテンプレートを保存する。
+    """
+    key = calc_template_bank_key(average, work_height)
+    prefix = f"templates_{work_height}p_"
+    path = os.path.join(cache_dir, f"{prefix}{key[:16]}.bin")
+    templates = load_template_bank_file(path, key)
+    if templates is not None:
+        return templates
+
+    templates = load_labeled_templates(average, work_height)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # labeled_chars が更新された同じ解像度の古いキャッシュ(と解像度別になる前のキャッシュ)は削除
+        for fname in os.listdir(cache_dir):
+            if fname.endswith(".bin") and (fname.startswith(prefix) or re.fullmatch(r"templates_[0-9a-f]{16}\.bin", fname)):
+                os.remove(os.path.join(cache_dir, fname))
+        save_template_bank(templates, path, key)
+    except OSError as e:
+        print(f"⚠️ テンプレートキャッシュを保存できません: {e}")
     return templates
 
 
 # === 1行テキストを認識 ===
-def recognize_text(line_img, labeled_dict, char_width, n_chars=40):
-    gray = preprocess(line_img)
+# この明るさを超える画素がある列を文字のある列とみなす(背景は 90 前後、文字は 200 以上)
+INK_LEVEL = 127
+# 文字のある範囲の幅が行の高さ(全角1文字分)のこの割合に満たない行は空行とみなす(未使用スロットの「-」など)
+MIN_TEXT_WIDTH_RATIO = 0.5
+# セルの境界が文字にかかっている場合に、文字の無い列を探す範囲(文字幅に対する割合)
+GLYPH_SNAP_RATIO = 0.5
+# 境界を合わせ直したセルに付ける左右の余白(文字幅に対する割合)
+GLYPH_MARGIN_RATIO = 0.2
+
+
+def is_blank_line(line_img):
+    """文字の無い行か(テンプレート照合の前に判定する)"""
+    gray = cv2.cvtColor(line_img, cv2.COLOR_BGR2GRAY) if len(line_img.shape) == 3 else line_img
+    cols = np.flatnonzero((gray > INK_LEVEL).any(axis=0))
+    return len(cols) == 0 or cols[-1] - cols[0] + 1 < gray.shape[0] * MIN_TEXT_WIDTH_RATIO
+
+
+def segment_glyphs(gray, char_width, n_chars):
+    """二値化した行画像の列方向の投影から、文字のあるセルの画像を切り出す
+
+    セルの境界は文字間隔どおりに置き、境界が文字にかかっている場合は近くの文字の無い列に合わせ直す
+    (幅の違う文字があっても以降のセルがずれていかないように)。合わせ直した以降のセルは、
+    文字の位置が画素単位では定まらないため上下左右に余白を付けて照合時に位置を探させる。
+    文字の無いセルと、最後の文字より右は含めない。
+    """
     h, w = gray.shape
-    result = ""
-    for i in range(n_chars):
-        x1 = i * char_width
-        x2 = min((i + 1) * char_width, w)
-        char_img = gray[:, x1:x2]
-        ch, score = match_best_char(char_img, labeled_dict)
-        if ch is None or (result and result[-1] == ch):
+    ink = np.count_nonzero(gray == 0, axis=0)
+    cols = np.flatnonzero(ink)
+    if len(cols) == 0 or cols[-1] - cols[0] + 1 < h * MIN_TEXT_WIDTH_RATIO:
+        return []
+    last = cols[-1]
+    blank_cols = np.flatnonzero(ink == 0)
+    radius = max(1, round(char_width * GLYPH_SNAP_RATIO))
+    bounds, snapped, shifted = [0], [False], [False]
+    shift = 0
+    for i in range(1, n_chars + 1):
+        pos = round(i * char_width) + shift
+        if pos >= w or bounds[-1] > last:
+            break
+        moved = False
+        if ink[pos]:
+            near = blank_cols[(blank_cols > bounds[-1]) & (np.abs(blank_cols - pos) <= radius)]
+            if len(near):
+                moved = True
+                snap = int(near[np.argmin(np.abs(near - pos))])
+                shift += snap - pos
+                pos = snap
+        bounds.append(pos)
+        snapped.append(moved)
+        shifted.append(shift != 0)
+
+    # 幅は切り上げて揃え、合わせ直した境界の手前では切る
+    cell_width = math.ceil(char_width)
+    margin = max(1, round(char_width * GLYPH_MARGIN_RATIO))
+    cells = []
+    for i, start in enumerate(bounds[:n_chars]):
+        if start > last:
             break
+        end = bounds[i + 1] if i + 1 < len(bounds) and snapped[i + 1] else start + cell_width
+        if not ink[start:end].any():
+            continue
+        if shifted[i] or (i + 1 < len(bounds) and snapped[i + 1]):
+            # 行の上下は背景で埋める(行より高いテンプレートもあるため)
+            cell = gray[:, max(0, start - margin):min(end + margin, w)]
+            cells.append(cv2.copyMakeBorder(cell, margin, margin, 0, 0, cv2.BORDER_CONSTANT, value=255))
+        else:
+            cells.append(gray[:, start:min(end, w)])
+    return cells
+
+
+def recognize_text(line_img, labeled_dict, char_width, n_chars=40, matcher=None, cache=None, cache_tag=""):
+    """(認識したテキスト, 確信度) を返す。確信度は照合した文字のスコアの平均(照合できなかった文字は 0)"""
+    # 空行(2行目の無い効果・未使用スロット)はテンプレート照合もキャッシュの参照もしない
+    if is_blank_line(line_img):
+        profiler.count("blank_lines")
+        return "", 1.0
+    gray = preprocess(line_img)
+    if cache is None:
+        return recognize_binarized_text(gray, labeled_dict, char_width, n_chars, matcher)
+
+    context = (cache_tag, char_width, n_chars)
+    result = cache.lookup(gray, context)
+    if result is None:
+        result = recognize_binarized_text(gray, labeled_dict, char_width, n_chars, matcher)
+        cache.store(gray, context, result)
+    return result
+
+
+def recognize_binarized_text(gray, labeled_dict, char_width, n_chars=40, matcher=None):
+    if matcher is None:
+        matcher = LoopMatcher(labeled_dict)
+    # char_width は小数も可。文字のあるセルだけを照合し、照合できなかった文字は読み飛ばす
+    cells = segment_glyphs(gray, char_width, n_chars)
+    result = ""
+    scores = []
+    for ch, score in matcher.match_cells(cells):
         result += ch if ch else ""
-    return unicodedata.normalize("NFC", result.strip())
+        scores.append(score if ch else 0.0)
+    confidence = sum(scores) / len(scores) if scores else 1.0
+    return unicodedata.normalize("NFC", result.strip()), confidence
 
 
 # === 効果文の照合 ===
-def find_closest_effect(text, effect_list):
+class EffectMatcher:
+    """効果リストの文字出現数を事前に集計し、difflib.get_close_matches(n=1) と同じ結果を少ない比較で返す
+
+    文字の出現数の共通部分(quick_ratio と同じ上限値)を文字ごとの転置表からまとめて求め、
+    上限値の高い候補から順に SequenceMatcher.ratio() を計算して、残りの上限値が現在の最良値を下回ったら打ち切る。
+    """
+
+    def __init__(self, effect_list):
+        self.effects = list(effect_list)
+        self.vocab = {}
+        for effect in self.effects:
+            for ch in effect:
+                self.vocab.setdefault(ch, len(self.vocab))
+        # 文字 → 各効果文での出現数 の転置表
+        self.char_counts = np.zeros((len(self.vocab), len(self.effects)), dtype=np.int32)
+        for i, effect in enumerate(self.effects):
+            for ch in effect:
+                self.char_counts[self.vocab[ch], i] += 1
+        self.lengths = np.array([len(effect) for effect in self.effects], dtype=np.int64)
+
+    def closest(self, text, cutoff=0.5):
+        """(最も近い効果文 or "", 一致率, 2番目に近い別の効果文の一致率) を返す
+
+        2番目の一致率は確信度の計算用で、cutoff 未満の場合は cutoff とする。
+        """
+        common = np.zeros(len(self.effects), dtype=np.int32)
+        for ch, n in Counter(text).items():
+            col = self.vocab.get(ch)
+            if col is not None:
+                common += np.minimum(self.char_counts[col], n)
+        upper = 2.0 * common / (self.lengths + len(text))
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(text)
+        best = None
+        runner_up = cutoff
+        for i in np.argsort(-upper, kind="stable"):
+            # 同点は get_close_matches と同じく文字列の大きい方を優先するため、上限値が並ぶ間は比較を続ける
+            # (2番目の候補も求めるため、上限値が2番目の一致率を上回る間も続ける)
+            if upper[i] < cutoff or (best is not None and upper[i] < best[0] and upper[i] <= runner_up):
+                break
+            effect = self.effects[i]
+            matcher.set_seq1(effect)
+            score = matcher.ratio()
+            if score < cutoff or (best is not None and effect == best[1]):
+                continue
+            if best is None or (score, effect) > best:
+                if best is not None:
+                    runner_up = max(runner_up, best[0])
+                best = (score, effect)
+            else:
+                runner_up = max(runner_up, score)
+        return (best[1], best[0], runner_up) if best else ("", 0.0, runner_up)
+
+
+# id(効果リスト) -> (効果リスト, EffectMatcher)。リスト自体も保持して id が再利用されないようにする
+_effect_matchers = {}
+
+
+def get_effect_matcher(effect_list):
+    """効果リストごとに EffectMatcher を1度だけ作成して返す"""
+    entry = _effect_matchers.get(id(effect_list))
+    if entry is None or entry[0] is not effect_list or len(entry[1].effects) != len(effect_list):
+        entry = (effect_list, EffectMatcher(effect_list))
+        _effect_matchers[id(effect_list)] = entry
+    return entry[1]
+
+
+def find_closest_effect(text, effect_list, cutoff=0.5):
+    """(最も近い効果文 or "", 確信度) を返す
+
+    確信度は1位と2位の一致率の差を、2位から満点までの幅で割ったもの(完全一致なら 1、2つの効果文と同点なら 0)。
+    """
     text = text.replace("※適用可能な武器種のみ", "").strip()
     if not text:
-        return ""
-    matches = difflib.get_close_matches(text, effect_list, n=1, cutoff=0.5)
-    return matches[0] if matches else ""
+        return "", 1.0
+    effect, score, runner_up = get_effect_matcher(effect_list).closest(text, cutoff)
+    if not effect:
+        return "", 0.0
+    return effect, (score - runner_up) / (1.0 - runner_up)
+
+
+# === 行画像の認識キャッシュ ===
+LINE_CACHE_SIZE = 2048
+# 完全一致しない場合に候補とする縮小画像の知覚ハッシュのハミング距離
+# (サンプル・4K・1440p・720p の動画で、同じ行どうしは最大 8 ビット)
+LINE_CACHE_PHASH_DIST = 16
+# 差分ピクセルを 2x2 で収縮して残る画素数がこれ以下なら同じ行とみなす
+# 再エンコードのノイズは文字の輪郭の1画素幅のずれなので収縮で消える。同じ行どうしは最大 1 画素、
+# 1文字だけ違う行(「筋力＋２」と「筋力＋３」など)は 3 画素以上残る
+LINE_CACHE_NOISE_PIXELS = 1
+LINE_CACHE_VERSION = 4
+
+
+class LineCache:
+    """preprocess 後の行画像 → (認識テキスト, 確信度) のキャッシュ(LRU)
+
+    行画像のハッシュで完全一致を探し、無ければ縮小画像の知覚ハッシュのハミング距離で候補を絞って
+    輪郭のずれ以外の差分ピクセルが LINE_CACHE_NOISE_PIXELS 以下なら同じ行とみなす。
+    find_closest_effect の結果もテキスト単位で保持し、path を指定すると実行をまたいで再利用する。
+    """
+
+    def __init__(self, max_entries=LINE_CACHE_SIZE, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.meta = None
+        self.exact = OrderedDict()    # digest -> (text, 確信度)
+        self.similar = OrderedDict()  # (context, 画像サイズ) -> [(知覚ハッシュ, packbits した行画像, (text, 確信度))]
+        self.closest = OrderedDict()  # (効果リスト, text) -> find_closest_effect の結果
+        self._catalog_keys = {}       # id(効果リスト) -> (効果リスト, 内容のハッシュ)
+        self.stats = Counter()
+
+    @staticmethod
+    def _keys(gray, context):
+        h, w = gray.shape
+        digest = hashlib.blake2b(repr((context, gray.shape)).encode() + gray.tobytes(), digest_size=16).digest()
+        small = cv2.resize(gray, (max(1, w // 8), max(1, h // 4)), interpolation=cv2.INTER_AREA)
+        return digest, (context, gray.shape), np.packbits(small > 127)
+
+    def _put(self, table, key, value):
+        table[key] = value
+        table.move_to_end(key)
+        if len(table) > self.max_entries:
+            table.popitem(last=False)
+
+    @staticmethod
+    def _same_line(gray, saved):
+        """輪郭の1画素幅のずれを除いた差分ピクセルが LINE_CACHE_NOISE_PIXELS 以下か"""
+        diff = ((gray > 127) != np.unpackbits(saved, count=gray.size).reshape(gray.shape).astype(bool)).astype(np.uint8)
+        return np.count_nonzero(cv2.erode(diff, np.ones((2, 2), np.uint8))) <= LINE_CACHE_NOISE_PIXELS
+
+    def lookup(self, gray, context):
+        """キャッシュ済みの (認識テキスト, 確信度) を返す。無ければ None"""
+        digest, group, phash = self._keys(gray, context)
+        result = self.exact.get(digest)
+        if result is not None:
+            self.exact.move_to_end(digest)
+            self.stats["hits"] += 1
+            return result
+
+        entries = self.similar.get(group)
+        if entries:
+            dist = np.bitwise_count(np.stack([e[0] for e in entries]) ^ phash).sum(axis=1)
+            for i in np.argsort(dist, kind="stable"):
+                if dist[i] > LINE_CACHE_PHASH_DIST:
+                    break
+                if self._same_line(gray, entries[i][1]):
+                    result = entries[i][2]
+                    entries.append(entries.pop(i))
+                    self.similar.move_to_end(group)
+                    self._put(self.exact, digest, result)
+                    self.stats["similar_hits"] += 1
+                    return result
+        self.stats["misses"] += 1
+        return None
+
+    def store(self, gray, context, result):
+        digest, group, phash = self._keys(gray, context)
+        self._put(self.exact, digest, result)
+        entries = self.similar.get(group, [])
+        entries.append((phash, np.packbits(gray > 127), result))
+        self._put(self.similar, group, entries[-self.max_entries:])
+
+    def _catalog_key(self, effect_list):
+        entry = self._catalog_keys.get(id(effect_list))
+        if entry is None or entry[0] is not effect_list:
+            entry = (effect_list, hashlib.sha1("\n".join(effect_list).encode("utf-8")).hexdigest()[:12])
+            self._catalog_keys[id(effect_list)] = entry
+        return entry[1]
+
+    def closest_effect(self, text, effect_list):
+        """find_closest_effect の結果をテキスト単位でキャッシュして返す"""
+        key = (self._catalog_key(effect_list), text)
+        matched = self.closest.get(key)
+        if matched is None:
+            self.stats["closest_misses"] += 1
+            matched = find_closest_effect(text, effect_list)
+        else:
+            self.stats["closest_hits"] += 1
+        self._put(self.closest, key, matched)
+        return matched
+
+    def take_stats(self):
+        """カウンタを返してリセット(ワーカーから集計する用)"""
+        stats, self.stats = self.stats, Counter()
+        return stats
+
+    def load(self, meta, log=print):
+        """path の保存内容を読み込む。テンプレートや解像度が異なる場合は読み込まない"""
+        self.meta = meta
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            log(f"⚠️ 行キャッシュを読み込めません: {e}")
+            return
+        if data.get("version") != LINE_CACHE_VERSION or data.get("meta") != meta:
+            return
+        for name in ("exact", "similar", "closest"):
+            for key, value in data[name]:
+                self._put(getattr(self, name), key, value)
+
+    def save(self):
+        if not self.path:
+            return
+        data = {
+            "version": LINE_CACHE_VERSION,
+            "meta": self.meta,
+            "exact": list(self.exact.items()),
+            "similar": list(self.similar.items()),
+            "closest": list(self.closest.items()),
+        }
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def spec(self):
+        """別プロセスで同じ設定のキャッシュを開くための情報"""
+        return self.max_entries, self.path, self.meta
+
+    def report(self, log=print):
+        s = self.stats
+        lines = s["hits"] + s["similar_hits"] + s["misses"]
+        closest = s["closest_hits"] + s["closest_misses"]
+        log(
+            f"Line cache: hits={s['hits']}, similar_hits={s['similar_hits']}, misses={s['misses']}"
+            f" ({(s['hits'] + s['similar_hits']) / lines * 100 if lines else 0:.1f}% hit),"
+            f" closest_effect hits={s['closest_hits']}, misses={s['closest_misses']}"
+            f" ({s['closest_hits'] / closest * 100 if closest else 0:.1f}% hit)"
+        )
+
+
+def line_cache_meta(frame_width, frame_height, decoder=DEFAULT_DECODER, matcher_backend=DEFAULT_MATCHER_BACKEND,
+                    cascade_k=DEFAULT_CASCADE_K):
+    """保存したキャッシュを再利用できる条件(テンプレートの内容・解像度・デコード方式・照合バックエンド)"""
+    return {
+        "templates": calc_template_bank_key(), "frame_size": [frame_width, frame_height], "decoder": decoder,
+        "matcher": matcher_backend, "cascade_k": cascade_k,
+    }
+
+
+def line_cache_spec(line_cache):
+    return line_cache.spec() if line_cache is not None else None
+
+
+def count_line_cache_stats(line_cache):
+    """行キャッシュのヒット数などをプロファイルのカウンタに加える"""
+    for name, n in line_cache.stats.items():
+        profiler.count(f"line_cache_{name}", n)
+
+
+def open_line_cache(spec):
+    """line_cache_spec の情報からキャッシュを開く(spec が None ならキャッシュ無し)"""
+    if spec is None:
+        return None
+    max_entries, path, meta = spec
+    line_cache = LineCache(max_entries, path)
+    line_cache.load(meta)
+    return line_cache
 
 
 # === CSV 出力 ===
-def save_csv(rows, path):
+CSV_HEADER = ["No.", "Name", "Color", "Effect1", "Effect2", "Effect3", "Disadvantage1", "Disadvantage2", "Disadvantage3"]
+# --confidence-columns で末尾に追加する列(recognize_relic の確信度リストと同じ並び)
+CONFIDENCE_HEADER = [f"{field}Confidence" for field in CSV_HEADER if field not in ("No.", "Color")]
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+
+def csv_header(confidence_columns=False):
+    return CSV_HEADER + CONFIDENCE_HEADER if confidence_columns else CSV_HEADER
+
+
+def save_csv(rows, path, header=CSV_HEADER):
     with open(path, "w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
-        writer.writerow(["No.", "Name", "Color", "Effect1", "Effect2", "Effect3", "Disadvantage1", "Disadvantage2", "Disadvantage3"])
+        writer.writerow(header)
         writer.writerows(rows)
 
 
+def relic_row(no, name_text, color, effects, disadvantages, confidences=None):
+    """CSV の1行。confidences を指定すると確信度の列を末尾に加える"""
+    row = [no, name_text, color] + effects + disadvantages
+    if confidences is not None:
+        row += [f"{confidence:.3f}" for confidence in confidences]
+    return row
+
+
+class StreamingCsvWriter:
+    """確定した行をその都度 CSV に追記・flush し、再開用のチェックポイントを CSV の横に保存する
+
+    チェックポイントには最後に認識したフレーム番号、重複判定用の last_name/last_effects、行数、
+    その時点の CSV のバイト数を記録する。再開時はチェックポイント以降に書かれた行を切り詰めてから追記する。
+    正常終了したらチェックポイントを削除する。
+    """
+
+    def __init__(self, path, video_info, resume=None, header=CSV_HEADER):
+        self.path = path
+        self.checkpoint_path = path + CHECKPOINT_SUFFIX
+        self.video_info = video_info
+        if resume is None:
+            self.file = open(path, "w", newline="", encoding="utf-8")
+            self.rows = 0
+        else:
+            with open(path, "r+b") as f:
+                f.truncate(resume["csv_bytes"])
+            self.file = open(path, "a", newline="", encoding="utf-8")
+            self.rows = resume["rows"]
+        self.writer = csv.writer(self.file)
+        if resume is None:
+            self.writer.writerow(header)
+            self.file.flush()
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+        self.rows += 1
+
+    def save_checkpoint(self, frame_idx, last_name, last_effects):
+        data = {
+            "version": CHECKPOINT_VERSION,
+            "video": self.video_info,
+            "frame_idx": frame_idx,
+            "last_name": last_name,
+            "last_effects": last_effects,
+            "rows": self.rows,
+            "csv_bytes": self.file.tell(),
+        }
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def complete(self):
+        """最後まで解析できたのでチェックポイントは不要"""
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_checkpoint(csv_path):
+    """csv_path のチェックポイントを返す。無い・読めない場合は None"""
+    try:
+        with open(csv_path + CHECKPOINT_SUFFIX, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != CHECKPOINT_VERSION or not os.path.exists(csv_path):
+        return None
+    return data
+
+
+def find_latest_checkpoint(directory):
+    """directory 内でチェックポイントが残っている最新の CSV のパスを返す"""
+    candidates = [
+        os.path.join(directory, name[:-len(CHECKPOINT_SUFFIX)])
+        for name in os.listdir(directory) if name.endswith(".csv" + CHECKPOINT_SUFFIX)
+    ]
+    candidates = [path for path in candidates if os.path.exists(path)]
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+
+# === 既存CSVとの差分取り込み(--since) ===
+# 既存CSVの先頭とこの件数連続で一致したら既知の遺物に到達したとみなす
+SINCE_MATCH_ROWS = 3
+
+
+def load_csv_rows(path):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return [row for row in reader if row]
+
+
+def load_csv_header(path):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return next(csv.reader(f), None)
+
+
+def relic_key(row):
+    """No. と色を除いた 遺物名・効果・デメリット で遺物を識別する(確信度の列は含めない)"""
+    values = [str(value) for value in row[1:len(CSV_HEADER)]]
+    values += [""] * (len(CSV_HEADER) - 1 - len(values))
+    return (values[0],) + tuple(values[2:])
+
+
+class KnownRelics:
+    """--since で指定した既存CSVの行
+
+    動画は新しく入手した遺物から始まり、その後ろに既存CSVの先頭行から同じ順で既知の遺物が続く前提。
+    """
+
+    def __init__(self, rows, match_rows=SINCE_MATCH_ROWS):
+        self.rows = rows
+        self.keys = [relic_key(row) for row in rows]
+        self.match_rows = min(match_rows, len(rows))
+
+    def reached(self, rows):
+        """認識済みの末尾 match_rows 件が既存CSVの先頭と一致したら True(以降は解析不要)"""
+        n = self.match_rows
+        return n > 0 and len(rows) >= n and [relic_key(row) for row in rows[-n:]] == self.keys[:n]
+
+    def merge(self, rows, log=print):
+        """新しい遺物の行 + 既存CSVの行 を No. を振り直して返す
+
+        動画の末尾が既存CSVの先頭と重なる部分は既知の遺物なので新しい行から除く。
+        """
+        overlap = 0
+        for n in range(min(len(rows), len(self.rows)), 0, -1):
+            if [relic_key(row) for row in rows[-n:]] == self.keys[:n]:
+                overlap = n
+                break
+        if overlap == 0 and self.rows:
+            log("⚠️ 動画内に既存CSVの先頭の遺物が見つかりませんでした。既存CSVの行をそのまま後ろに結合します")
+        new_rows = rows[:len(rows) - overlap]
+        log(f"New relics: {len(new_rows)}, known relics: {len(self.rows)}")
+        return [[i + 1] + list(row[1:]) for i, row in enumerate(new_rows + self.rows)]
+
+
 # === ROI 切り出し（デバッグ出力付き） ===
 def crop_region(gray, rect, label):
     y1, y2, x1, x2 = rect["y1"], rect["y2"], rect["x1"], rect["x2"]
@@ -846,125 +2317,943 @@ def crop_region(gray, rect, label):
     return gray[y1:y2, x1:x2]
 
 
-# === 動画解析 ===
-def analyze_relics(cap, frame, templates):
+# === 動画サイズに合わせた ROI/文字幅 ===
+def build_relic_layout(frame_width, frame_height, crop=None, work_height=WORK_HEIGHT):
+    """crop(フレーム供給元で切り出した範囲)を指定すると、切り出し後の画像上の座標にする
 
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    print("Total frame:", total_frames)
-    FRAME_HEIGHT, FRAME_WIDTH = frame.shape[:2]
-    print("Detected frame size:", FRAME_WIDTH, FRAME_HEIGHT)
-    name_char_width = int(CALC_BASE_RELIC_NAME_CHAR_WIDTH * FRAME_WIDTH / CALC_BASE_WIDTH)
-    effect_char_width = int(CALC_BASE_RELIC_EFFECT_CHAR_WIDTH * FRAME_WIDTH / CALC_BASE_WIDTH)
+    認識用の座標・文字幅(panel_rois など)は高さ work_height に拡大縮小したパネル画像(panel_size)上の値。
+    """
+    rois = relic_rois(frame_width, frame_height)
+    diff_region = scaled_rect(1855, 1487, 3820, 1960, frame_width, frame_height)
+    # 認識は差分判定で切り出したパネル画像を work_height 相当に揃えて行う
+    work_width, work_height = normalized_size((frame_width, frame_height), work_height)
+    work_rois = relic_rois(work_width, work_height)
+    work_panel = scaled_rect(1855, 1487, 3820, 1960, work_width, work_height)
+    if crop is not None:
+        rois = {key: offset_rect(rect, crop) for key, rect in rois.items()}
+        diff_region = offset_rect(diff_region, crop)
+    return {
+        "rois": rois,
+        "diff_region": diff_region,
+        "panel_size": (work_panel["x2"] - work_panel["x1"], work_panel["y2"] - work_panel["y1"]),
+        "panel_rois": {key: offset_rect(rect, work_panel) for key, rect in work_rois.items()},
+        # 遺物名は全体で1セル。効果文の文字幅は小数のまま(1080p 相当なら 20)
+        "name_width": round(CALC_BASE_RELIC_NAME_CHAR_WIDTH * RELIC_NAME_CHARS * work_width / CALC_BASE_WIDTH),
+        "effect_char_width": CALC_BASE_RELIC_EFFECT_CHAR_WIDTH * work_width / CALC_BASE_WIDTH,
+    }
 
-    # ROI 定義（動画サイズに合わせて変換）
-    ROIS = {
-        "name": scaled_rect(2150, 1550, 2900, 1600, FRAME_WIDTH, FRAME_HEIGHT),
-        "effect1_1": scaled_rect(2220, 1630, 3820, 1670, FRAME_WIDTH, FRAME_HEIGHT),
-        "effect1_2": scaled_rect(2220, 1678, 3820, 1720, FRAME_WIDTH, FRAME_HEIGHT),
-        "effect2_1": scaled_rect(2220, 1750, 3820, 1790, FRAME_WIDTH, FRAME_HEIGHT),
-        "effect2_2": scaled_rect(2220, 1798, 3820, 1840, FRAME_WIDTH, FRAME_HEIGHT),
-        "effect3_1": scaled_rect(2220, 1870, 3820, 1910, FRAME_WIDTH, FRAME_HEIGHT),
-        "effect3_2": scaled_rect(2220, 1918, 3820, 1960, FRAME_WIDTH, FRAME_HEIGHT),
+
+def relic_rois(frame_width, frame_height):
+    return {
+        "name": scaled_rect(2150, 1550, 2900, 1600, frame_width, frame_height),
+        "effect1_1": scaled_rect(2220, 1630, 3820, 1670, frame_width, frame_height),
+        "effect1_2": scaled_rect(2220, 1678, 3820, 1720, frame_width, frame_height),
+        "effect2_1": scaled_rect(2220, 1750, 3820, 1790, frame_width, frame_height),
+        "effect2_2": scaled_rect(2220, 1798, 3820, 1840, frame_width, frame_height),
+        "effect3_1": scaled_rect(2220, 1870, 3820, 1910, frame_width, frame_height),
+        "effect3_2": scaled_rect(2220, 1918, 3820, 1960, frame_width, frame_height),
     }
-    DIFF_REGION = scaled_rect(1855, 1487, 3820, 1960, FRAME_WIDTH, FRAME_HEIGHT)
 
-    rows = []
-    last_name = last_effects = prev_gray = None
 
-    try:
-        frame_idx = 0
-        while True:
+def normalize_panel(gray, layout):
+    """パネル画像を認識する解像度(layout の panel_size)に揃える"""
+    size = layout["panel_size"]
+    if gray.shape[1::-1] == size:
+        return gray
+    interpolation = cv2.INTER_AREA if gray.shape[0] > size[1] else cv2.INTER_LANCZOS4
+    return cv2.resize(gray, size, interpolation=interpolation)
+
+
+# === 効果スロットのレイアウト判定 ===
+# 区切りの「｜」とみなす縦線の条件(幅・左右の空白は文字幅、高さは行の高さに対する割合)
+PIPE_MAX_WIDTH_RATIO = 0.25
+PIPE_MIN_HEIGHT_RATIO = 0.8
+PIPE_MIN_GAP_RATIO = 0.4
+# 縦線の中心がセルの中央からこの範囲(文字幅に対する割合)にあること(「目」「口」などの縦画と区別する)
+PIPE_CENTER_RATIO = 1 / 6
+SLOT_LAYOUTS = ["empty", "single", "pipe", "wrapped", "split"]
+
+
+def find_pipe(line_img, char_width):
+    """行画像の中の区切りの縦線「｜」の (開始列, 終了列)。無ければ None
+
+    列方向の投影で、左右を空白に挟まれ、セルの中央にある細く縦に長い線を探す(前後に文字があるものだけ)。
+    """
+    gray = preprocess(line_img)
+    h, w = gray.shape
+    ink = np.count_nonzero(gray == 0, axis=0)
+    # 文字のある列が続く区間 [開始, 終了)
+    runs = np.flatnonzero(np.diff(np.concatenate(([0], (ink > 0).astype(np.int8), [0])))).reshape(-1, 2)
+    for k in range(1, len(runs) - 1):
+        start, end = runs[k]
+        center = (start + end - 1) / 2
+        offset = center - (math.floor(center / char_width) + 0.5) * char_width
+        if (end - start <= max(1, char_width * PIPE_MAX_WIDTH_RATIO)
+                and ink[start:end].max() >= h * PIPE_MIN_HEIGHT_RATIO
+                and min(start - runs[k - 1][1], runs[k + 1][0] - end) >= char_width * PIPE_MIN_GAP_RATIO
+                and abs(offset) <= char_width * PIPE_CENTER_RATIO):
+            return int(start), int(end)
+    return None
+
+
+def classify_effect_slot(line1, line2, char_width, has_disadvantages):
+    """効果スロット(2行)のレイアウトと、区切りの縦線の位置を返す
+
+    empty: 効果なし / single: 1行目だけ / pipe: 1行目に「効果｜デメリット」 /
+    wrapped: 効果文が2行に折り返し / split: 1行目が効果、2行目がデメリット
+    2行とも文字がある場合は、遺物の種類(デメリットがあるか)で wrapped と split を分ける。
+    深層の遺物でもデメリットの無い効果文が折り返すことがあるため、split は認識後に折り返しとして照合し直すことがある。
+    """
+    if is_blank_line(line1):
+        return "empty", None
+    pipe = find_pipe(line1, char_width)
+    if pipe is not None:
+        return "pipe", pipe
+    if is_blank_line(line2):
+        return "single", None
+    return ("split" if has_disadvantages else "wrapped"), None
+
+
+# === 認識結果の確信度 ===
+# 確信度がこの値未満の項目は、同じ遺物を表示している後続フレームでも認識し直して多数決で決める
+DEFAULT_MIN_CONFIDENCE = 0.5
+# 読み直しに使う後続フレームの最大数(0 なら読み直さない)
+DEFAULT_VOTE_FRAMES = 2
+
+
+def vote(reads):
+    """(値, 確信度) の読み取り結果のうち、確信度の合計が最も大きい値を (値, 確信度) で返す
+
+    確信度は選んだ値の確信度の合計を読み取り回数で割ったもの(読み取り結果が割れるほど下がる)。同点なら先の読み取りを優先する。
+    """
+    totals = {}
+    for value, confidence in reads:
+        totals[value] = totals.get(value, 0.0) + confidence
+    value = max(totals, key=totals.get)
+    return value, totals[value] / len(reads)
+
+
+# === パネル画像から遺物1件を認識 ===
+def closest_effect_func(cache, frame_idx):
+    """効果文の照合に使う関数(行キャッシュ・プロファイルの有無に合わせる)"""
+    closest_effect = cache.closest_effect if cache is not None else find_closest_effect
+    if not profiler.enabled:
+        return closest_effect
+
+    def timed_closest_effect(text, effect_list):
+        with profiler.span("fuzzy_match", frame_idx):
+            return closest_effect(text, effect_list)
+    return timed_closest_effect
+
+
+def recognize_name(gray, matchers, layout, frame_idx, cache=None):
+    """認識する解像度に揃えたパネル画像から (遺物名, 確信度) を返す"""
+    name_img = crop_region(gray, layout["panel_rois"]["name"], "name")
+    with profiler.span("name", frame_idx):
+        return recognize_text(name_img, None, layout["name_width"], 1, matchers["name"], cache, "name")
+
+
+def recognize_effect_slot(gray, i, matchers, layout, has_disadvantages, frame_idx, cache=None, log=print):
+    """認識する解像度に揃えたパネル画像の i 番目の効果スロットから ((効果, 確信度), (デメリット, 確信度)) を返す
+
+    効果・デメリットの確信度は、行の文字スコアの確信度と効果文の照合の確信度の積。
+    """
+    panel_rois = layout["panel_rois"]
+    effect_char_width = layout["effect_char_width"]
+    closest_effect = closest_effect_func(cache, frame_idx)
+    line1 = crop_region(gray, panel_rois[f"effect{i}_1"], f"effect{i}_1")
+    line2 = crop_region(gray, panel_rois[f"effect{i}_2"], f"effect{i}_2")
+    # 文字認識の前に画素からレイアウトを判定し、レイアウトごとに1通りだけ認識・照合する
+    slot, pipe = classify_effect_slot(line1, line2, effect_char_width, has_disadvantages)
+    profiler.count(f"slot_{slot}")
+
+    def read(line_img, part):
+        with profiler.span(f"effect{i}_{part}", frame_idx):
+            return recognize_text(line_img, None, effect_char_width, RELIC_EFFECT_CHARS, matchers["effect"], cache, "effect")
+
+    def match(text, text_confidence, effect_list):
+        matched, confidence = closest_effect(text, effect_list)
+        return matched, text_confidence * confidence
+
+    effect = disadvantage = ("", 1.0)
+    if slot == "pipe":
+        # 1行に効果とデメリットが「｜」で区切られている場合は、区切りの前後のセルを別々に認識する
+        left = line1[:, :round(math.floor(pipe[0] / effect_char_width) * effect_char_width)]
+        right = line1[:, round(math.ceil(pipe[1] / effect_char_width) * effect_char_width):]
+        effect = match(*read(left, 1), EFFECT_LIST)
+        if has_disadvantages:
+            disadvantage = match(*read(right, 1), DISADVANTAGE_EFFECTS)
+    elif slot == "single":
+        line1_text, confidence = read(line1, 1)
+        if "|" in line1_text or "｜" in line1_text:
+            # 区切りの縦線を画素から判定できなくても、文字として認識できた場合はそこで分ける
+            part1, part2 = re.split(r'[|｜]', line1_text, 1)
+            effect = match(part1.strip(), confidence, EFFECT_LIST)
+            if has_disadvantages:
+                disadvantage = match(part2.strip(), confidence, DISADVANTAGE_EFFECTS)
+        else:
+            effect = match(line1_text, confidence, EFFECT_LIST)
+    elif slot == "wrapped":
+        # 効果文が2行に折り返している(2行目の「※適用可能な武器種のみ」は照合時に取り除く)
+        (text1, confidence1), (text2, confidence2) = read(line1, 1), read(line2, 2)
+        effect = match(text1 + text2, min(confidence1, confidence2), EFFECT_LIST)
+    elif slot == "split":
+        # 1行目が効果、2行目がデメリット
+        (text1, confidence1), (text2, confidence2) = read(line1, 1), read(line2, 2)
+        effect = match(text1, confidence1, EFFECT_LIST)
+        disadvantage = match(text2, confidence2, DISADVANTAGE_EFFECTS)
+        if effect[0] not in HAS_DISADVANTEGE_EFFECT_NAMES:
+            # デメリットの付く効果でなければ、デメリットの無い効果文が2行に折り返している可能性があるので結合して照合し直す
+            profiler.count("slot_split_retried")
+            wrapped = match(text1 + text2, min(confidence1, confidence2), EFFECT_LIST)
+            if wrapped[1] >= effect[1]:
+                effect = wrapped
+
+    if effect[0] not in HAS_DISADVANTEGE_EFFECT_NAMES:
+        # デメリットの無い効果なら、デメリットが空であることの確信度は効果の確信度と同じ
+        disadvantage = ("", effect[1] if has_disadvantages else 1.0)
+    elif disadvantage[0] == "" and has_disadvantages:
+        log(f"Frame {frame_idx}: Effect {i}: {effect[0]}: Disadvantage analyze error!!")
+        disadvantage = ("", 0.0)
+    return effect, disadvantage
+
+
+def recognize_relic(gray, matchers, layout, frame_idx, cache=None, neighbours=(), min_confidence=DEFAULT_MIN_CONFIDENCE,
+                    log=print):
+    """(遺物名, 色, 効果リスト, デメリットリスト, 確信度リスト) を返す
+
+    確信度リストは CSV と同じ並び(遺物名、効果1〜3、デメリット1〜3)。
+    確信度が min_confidence 未満の項目は、neighbours(同じ遺物を表示している後続フレームのパネル画像)でも
+    認識し直して多数決で決める。効果とデメリットはスロット単位で読み直す。
+    """
+    profiler.count("frames_recognized")
+    gray = normalize_panel(gray, layout)
+    others = []
+
+    def neighbour_panels():
+        if not others:
+            others.extend(normalize_panel(panel, layout) for panel in neighbours)
+        return others
+
+    # === 名前 ===
+    name = recognize_name(gray, matchers, layout, frame_idx, cache)
+    if neighbours and name[1] < min_confidence:
+        profiler.count("revoted_fields")
+        name = vote([name] + [recognize_name(panel, matchers, layout, frame_idx, cache) for panel in neighbour_panels()])
+    relic_info = RELIC_INFO_DICT[name[0]]
+    has_disadvantages = relic_info["type"] == "depth"
+
+    # === 効果 ===
+    effects = []
+    disadvantages = []
+    for i in range(1, 4):
+        effect, disadvantage = recognize_effect_slot(gray, i, matchers, layout, has_disadvantages, frame_idx, cache, log)
+        if neighbours and min(effect[1], disadvantage[1]) < min_confidence:
+            profiler.count("revoted_fields")
+            reads = [(effect, disadvantage)] + [
+                recognize_effect_slot(panel, i, matchers, layout, has_disadvantages, frame_idx, cache, log)
+                for panel in neighbour_panels()
+            ]
+            effect = vote([e for e, _ in reads])
+            disadvantage = vote([d for e, d in reads if e[0] == effect[0]])
+        effects.append(effect)
+        disadvantages.append(disadvantage)
+
+    fields = [("Name", name)] + [(f"Effect{i + 1}", f) for i, f in enumerate(effects)] + [
+        (f"Disadvantage{i + 1}", f) for i, f in enumerate(disadvantages)
+    ]
+    for field, (value, confidence) in fields:
+        if confidence < min_confidence:
+            profiler.count("low_confidence_fields")
+            log(f"Frame {frame_idx}: low confidence {field}: '{value}' ({confidence:.2f})")
+    return (name[0], relic_info["color"], [e for e, _ in effects], [d for d, _ in disadvantages],
+            [confidence for _, (_, confidence) in fields])
+
+
+# === フレームの供給元 ===
+def open_relic_source(path, frame_source="auto", scale=None, crop_panel=False, log=print):
+    """動画/画像ディレクトリを開く。crop_panel なら遺物パネルの範囲だけを読み込む(ffmpeg はデコード時に切り出す)"""
+    source = open_frame_source(path, frame_source, scale, log)
+    if crop_panel and min(source.full_size) > 0:
+        source.set_crop(build_relic_layout(*source.full_size)["diff_region"])
+    return source
+
+
+def source_frame_size(cap, frame):
+    """ROI 計算の基準にする (幅, 高さ)。切り出し済みのフレームでも切り出し前のサイズを返す"""
+    return tuple(getattr(cap, "full_size", None) or frame.shape[1::-1])
+
+
+# === デコード＋差分チェック ===
+def iter_changed_panels(cap, gate, total_frames, start_frame=1, end_frame=None, show_progress=True, vote_frames=0):
+    """差分判定を通過したフレームの (フレーム番号, パネルのグレースケール画像, 後続フレームのパネル画像のリスト) を順に返す
+
+    cap は start_frame の位置から読み込める状態であること。end_frame(含まない) に達したら終了する。
+    静止しきる前のパネルは動画の終端でだけ返す。end_frame で打ち切った区間の境界がフェード中でも
+    描画途中のパネルは認識せず、次の区間(重なり部分から読み込む)に任せる。
+    vote_frames を指定すると、通過したフレームの後もパネルが変化しない間、最大 vote_frames フレーム分の
+    パネル画像を読み進めて添える(確信度の低い項目を読み直す用)。
+    """
+    pending = None
+    frame_idx = start_frame - 1
+    at_end = True
+    while end_frame is None or frame_idx + 1 < end_frame:
+        with profiler.span("decode", frame_idx + 1):
             ret, frame = cap.read()
-            if not ret:
-                break
-            frame_idx += 1
+        if not ret:
+            break
+        frame_idx += 1
+        profiler.count("frames_decoded")
 
+        if show_progress:
             progress = math.floor(frame_idx / total_frames * 100 * 10) / 10
             print(f"Frame {frame_idx}/{total_frames} ({progress:.1f}%)", end='\r')
 
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            # === 差分チェック ===
-            if prev_gray is not None:
-                diff_value = calc_region_diff(prev_gray, gray, DIFF_REGION)
-                if diff_value <= FRAME_SKIP_DIFF_TH:
-                    continue
-            prev_gray = gray.copy()
-
-            # === 名前 ===
-            name_img = crop_region(gray, ROIS["name"], "name")
-            name_text = recognize_text(name_img, templates["name"], name_char_width * RELIC_NAME_CHARS, 1)
-            relic_info = RELIC_INFO_DICT[name_text]
-            has_disadvantages = relic_info["type"] == "depth"
-
-            # === 効果 ===
-            effects = []
-            disadvantages = []
-            for i in range(1, 4):
-                line1 = crop_region(gray, ROIS[f"effect{i}_1"], f"effect{i}_1")
-                line2 = crop_region(gray, ROIS[f"effect{i}_2"], f"effect{i}_2")
-
-                line1_text = recognize_text(line1, templates["effect"], effect_char_width, RELIC_EFFECT_CHARS)
-                line2_text = recognize_text(line2, templates["effect"], effect_char_width, RELIC_EFFECT_CHARS)
-
-                if "|" in line1_text or  "｜" in line1_text:
-                    # 1行に効果とデメリットが混在している場合
-                    part1, part2 = re.split(r'[|｜]', line1_text, 1)
-                    matched_effect = find_closest_effect(part1.strip(), EFFECT_LIST)
-                    matched_disadvantage = find_closest_effect(part2.strip(), DISADVANTAGE_EFFECTS) if has_disadvantages else ""
-                else:
-                    # 2行に分かれている or パイプ(|)が認識できなかった場合
-                    matched_effect = find_closest_effect(line1_text, EFFECT_LIST)
-                    matched_disadvantage = find_closest_effect(line2_text, DISADVANTAGE_EFFECTS) if has_disadvantages else ""
-                    if not matched_effect and not matched_disadvantage:
-                        # 2行に分かれている想定でテキストを結合して処理
-                        combined = line1_text + line2_text
-                        matched_effect = find_closest_effect(combined, EFFECT_LIST)
-                        matched_disadvantage = find_closest_effect(combined, DISADVANTAGE_EFFECTS) if has_disadvantages else ""
-                    elif matched_effect and not matched_disadvantage and has_disadvantages:
-                        # 効果は見つかったけどデメリットが見つからない場合、1行目にまとまっている想定でチェック
-                        matched_disadvantage = find_closest_effect(line1_text, DISADVANTAGE_EFFECTS)
-
-                if matched_effect not in HAS_DISADVANTEGE_EFFECT_NAMES:
-                    matched_disadvantage = "";
-                elif matched_disadvantage == "" and has_disadvantages:
-                    print(f"Frame {frame_idx}: Effect {i}: {matched_effect}: Disadvantage analyze error!!")
-
-                effects.append(matched_effect)
-                disadvantages.append(matched_disadvantage)
+        # === 差分チェック ===
+        with profiler.span("gate", frame_idx):
+            gray, _ = gate.feed(frame)
+            if gray is None and pending is not None and gate.steady():
+                pending[2].append(gate.panel(frame))
+        if gray is None:
+            profiler.count("frames_gated_out")
+        if pending is not None and (gray is not None or not gate.steady() or len(pending[2]) >= vote_frames):
+            yield pending
+            pending = None
+        if gray is not None:
+            pending = (frame_idx, gray, [])
+            if vote_frames <= 0:
+                yield pending
+                pending = None
+    else:
+        at_end = False
+
+    if pending is not None:
+        yield pending
+    if not at_end:
+        return
+    gray, _ = gate.flush()
+    if gray is not None:
+        yield frame_idx, gray, []
+
+
+# === 認識ワーカー(プロセスプール) ===
+_worker_state = {}
+
+
+def init_recognition_worker(matcher_backend, decoder, use_template_cache, layout, line_cache_spec=None, profile=False,
+                            cascade_k=DEFAULT_CASCADE_K, min_confidence=DEFAULT_MIN_CONFIDENCE):
+    """ワーカープロセスごとに1度だけテンプレートを読み込む"""
+    if profile:
+        enable_profiler()
+    templates = load_template_bank() if use_template_cache else load_labeled_templates()
+    _worker_state["matchers"] = create_matchers(templates, matcher_backend, decoder, cascade_k)
+    _worker_state["layout"] = layout
+    _worker_state["line_cache"] = open_line_cache(line_cache_spec)
+    _worker_state["min_confidence"] = min_confidence
+
+
+def recognize_relic_in_worker(frame_idx, gray, neighbours):
+    cache = _worker_state["line_cache"]
+    result = recognize_relic(gray, _worker_state["matchers"], _worker_state["layout"], frame_idx, cache, neighbours,
+                             _worker_state["min_confidence"])
+    return frame_idx, result, cache.take_stats() if cache is not None else None, take_profile()
+
 
+def iter_recognized_parallel(panels, workers, init_args, max_pending=None):
+    """panels をワーカーで認識し、フレーム順に (フレーム番号, 認識結果, 行キャッシュのカウンタ, プロファイル) を返す
+
+    未完了のジョブは max_pending 件までに抑え、メモリ使用量を一定に保つ。
+    """
+    max_pending = max_pending or workers * 2
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_recognition_worker, initargs=init_args) as pool:
+        try:
+            for frame_idx, gray, neighbours in panels:
+                pending.append(pool.submit(recognize_relic_in_worker, frame_idx, gray, neighbours))
+                # 先頭から順に取り出すことでフレーム順を保つ
+                while len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+# === 動画解析 ===
+def analyze_relics(cap, frame, templates, matcher_backend=DEFAULT_MATCHER_BACKEND, diff_gate=DEFAULT_DIFF_GATE,
+                   settle_frames=DEFAULT_SETTLE_FRAMES, workers=1, use_template_cache=True, line_cache=None,
+                   decoder=DEFAULT_DECODER, output=None, resume=None, known=None, show_progress=True,
+                   cascade_k=DEFAULT_CASCADE_K, buffer_pool=False, vote_frames=DEFAULT_VOTE_FRAMES,
+                   min_confidence=DEFAULT_MIN_CONFIDENCE, confidence_columns=False, log=print, matchers=None):
+    """遺物一覧の行を返す
+
+    output(StreamingCsvWriter) を指定すると行が確定するたびに追記し、認識したフレームごとにチェックポイントを保存する。
+    resume(チェックポイント)を指定すると、そのフレームの次から解析を続ける。
+    known(KnownRelics) を指定すると、既存CSVの遺物に到達した時点で解析を打ち切る。
+    buffer_pool=True ならデコード・差分判定の配列を使い回し、終了時にバッファの大きさと最大常駐メモリを表示する。
+    確信度が min_confidence 未満の項目は後続の最大 vote_frames フレームでも読み直す。
+    confidence_columns=True なら行の末尾に項目ごとの確信度を加える。
+    ログは log に1行ずつ渡す(進捗表示 show_progress は標準出力に直接書く)。
+    matchers に create_matchers で作成済みの照合器を渡すと、作り直さずに使う(workers > 1 の場合は各ワーカーで作成する)。
+    """
+
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    log("Total frame:", total_frames)
+    FRAME_WIDTH, FRAME_HEIGHT = source_frame_size(cap, frame)
+    log("Detected frame size:", FRAME_WIDTH, FRAME_HEIGHT)
+
+    # ROI 定義（動画サイズに合わせて変換）
+    layout = build_relic_layout(FRAME_WIDTH, FRAME_HEIGHT, getattr(cap, "crop", None))
+    if buffer_pool:
+        enable_buffer_pool(cap, log)
+    gate = create_gate(layout["diff_region"], diff_gate, settle_frames, buffer_pool)
+    start_frame = 1
+    if resume is not None:
+        # 最後に認識したフレームを差分判定の基準にして、その次のフレームから読み込む
+        cap.set(cv2.CAP_PROP_POS_FRAMES, resume["frame_idx"])
+        ret, frame = cap.read()
+        if ret:
+            gate.prime(frame)
+        start_frame = resume["frame_idx"] + 1
+        log(f"Resume from frame {start_frame} ({resume['rows']} rows)")
+    panels = iter_changed_panels(cap, gate, total_frames, start_frame, show_progress=show_progress,
+                                 vote_frames=vote_frames)
+    if line_cache is not None:
+        line_cache.load(line_cache_meta(FRAME_WIDTH, FRAME_HEIGHT, decoder, matcher_backend, cascade_k), log)
+    if workers > 1:
+        init_args = (matcher_backend, decoder, use_template_cache, layout, line_cache_spec(line_cache), profiler.enabled,
+                     cascade_k, min_confidence)
+        recognized = iter_recognized_parallel(panels, workers, init_args)
+    else:
+        if matchers is None:
+            matchers = create_matchers(templates, matcher_backend, decoder, cascade_k)
+        recognized = (
+            (frame_idx, recognize_relic(gray, matchers, layout, frame_idx, line_cache, neighbours, min_confidence, log),
+             None, None)
+            for frame_idx, gray, neighbours in panels
+        )
+
+    rows = []
+    last_name = last_effects = None
+    row_offset = 0
+    if resume is not None:
+        last_name, last_effects, row_offset = resume["last_name"], resume["last_effects"], resume["rows"]
+
+    try:
+        for frame_idx, (name_text, color, effects, disadvantages, confidences), cache_stats, profile in recognized:
+            if cache_stats:
+                line_cache.stats.update(cache_stats)
+            merge_profile(profile)
             # === 前フレームと重複チェック ===
-            print(f"Frame {frame_idx}: Name='{name_text}', Effects={effects}, Disadvantages={disadvantages}")
+            log(f"Frame {frame_idx}: Name='{name_text}', Effects={effects}, Disadvantages={disadvantages}")
+            if name_text != last_name or effects != last_effects:
+                row = relic_row(row_offset + len(rows) + 1, name_text, color, effects, disadvantages,
+                                confidences if confidence_columns else None)
+                rows.append(row)
+                last_name, last_effects = name_text, effects
+                if output is not None:
+                    output.write_row(row)
+                if known is not None and known.reached(rows):
+                    log(f"Frame {frame_idx}: 既存CSVの遺物に到達したため解析を終了します")
+                    break
+            if output is not None:
+                output.save_checkpoint(frame_idx, last_name, last_effects)
+
+        else:
+            if output is not None:
+                output.complete()
+    except KeyboardInterrupt:
+        log("Interrupted by user.")
+    finally:
+        recognized.close()
+
+    if line_cache is not None:
+        # 並列実行時はワーカーごとのキャッシュなので保存しない
+        if workers <= 1:
+            line_cache.save()
+        line_cache.report(log)
+        count_line_cache_stats(line_cache)
+    if buffer_pool:
+        report_memory(cap, gate, log)
+    return rows
+
+
+# === 区間分割による並列解析 ===
+SEGMENT_OVERLAP_FRAMES = 30
+
+
+def analyze_segment(video_path, start_frame, end_frame, overlap, matcher_backend, diff_gate, settle_frames,
+                    use_template_cache, line_cache_spec=None, decoder=DEFAULT_DECODER, profile=False,
+                    source_options=None, cascade_k=DEFAULT_CASCADE_K, buffer_pool=False, vote_frames=DEFAULT_VOTE_FRAMES,
+                    min_confidence=DEFAULT_MIN_CONFIDENCE):
+    """動画の [start_frame, end_frame) 区間を解析し、((フレーム番号, 遺物名, 色, 効果, デメリット, 確信度) のリスト, 行キャッシュのカウンタ, プロファイル) を返す
+
+    差分判定の基準を安定させるため、start_frame の overlap フレーム前から読み込む。
+    """
+    if profile:
+        enable_profiler()
+    templates = load_template_bank() if use_template_cache else load_labeled_templates()
+    matchers = create_matchers(templates, matcher_backend, decoder, cascade_k)
+    line_cache = open_line_cache(line_cache_spec)
+    cap = open_relic_source(video_path, **(source_options or {}))
+    try:
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        layout = build_relic_layout(*cap.full_size, cap.crop)
+        if buffer_pool:
+            cap.enable_buffer_pool()
+        gate = create_gate(layout["diff_region"], diff_gate, settle_frames, buffer_pool)
+        read_from = max(1, start_frame - overlap)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, read_from)
+
+        records = []
+        last_name = last_effects = None
+        panels = iter_changed_panels(cap, gate, total_frames, read_from, end_frame, show_progress=False,
+                                     vote_frames=vote_frames)
+        for frame_idx, gray, neighbours in panels:
+            name_text, color, effects, disadvantages, confidences = recognize_relic(
+                gray, matchers, layout, frame_idx, line_cache, neighbours, min_confidence
+            )
             if name_text == last_name and effects == last_effects:
                 continue
+            records.append((frame_idx, name_text, color, effects, disadvantages, confidences))
+            last_name, last_effects = name_text, effects
+        return records, line_cache.take_stats() if line_cache is not None else None, take_profile()
+    finally:
+        cap.release()
 
-            rows.append([len(rows) + 1, name_text, relic_info["color"]] + effects + disadvantages)
+
+def merge_segment_records(segments, confidence_columns=False):
+    """区間ごとの認識結果を連結して CSV 行にする
+
+    segments は (区間の開始フレーム, records) のリスト。重複読み込みした区間より前の結果は
+    前の区間が担当しているので捨て、境界をまたいで同じ遺物が続く場合は1件にまとめて No. を振り直す。
+    """
+    rows = []
+    last_name = last_effects = None
+    for start_frame, records in segments:
+        for frame_idx, name_text, color, effects, disadvantages, confidences in records:
+            if frame_idx < start_frame:
+                continue
+            if name_text == last_name and effects == last_effects:
+                continue
+            rows.append(relic_row(len(rows) + 1, name_text, color, effects, disadvantages,
+                                  confidences if confidence_columns else None))
             last_name, last_effects = name_text, effects
+    return rows
+
+
+def segment_bounds(total_frames, n_segments):
+    """各区間の開始フレーム番号のリスト(末尾は終端を表す None)"""
+    # 先頭フレームは逐次解析と同じくサイズ確認用として扱い、1 から解析する
+    return [1 + (total_frames - 1) * k // n_segments for k in range(n_segments)] + [None]
+
+
+def analyze_relics_segmented(video_path, n_segments, overlap=SEGMENT_OVERLAP_FRAMES,
+                             matcher_backend=DEFAULT_MATCHER_BACKEND, diff_gate=DEFAULT_DIFF_GATE,
+                             settle_frames=DEFAULT_SETTLE_FRAMES, use_template_cache=True, line_cache=None,
+                             decoder=DEFAULT_DECODER, source_options=None, cascade_k=DEFAULT_CASCADE_K,
+                             buffer_pool=False, vote_frames=DEFAULT_VOTE_FRAMES, min_confidence=DEFAULT_MIN_CONFIDENCE,
+                             confidence_columns=False):
+    """動画を n_segments 個の区間に分け、区間ごとに別プロセスでフレーム供給元を開いて解析する"""
+    cap = open_relic_source(video_path, **(source_options or {}))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_width, frame_height = cap.full_size
+    cap.release()
+    print("Total frame:", total_frames)
+    if line_cache is not None:
+        line_cache.load(line_cache_meta(frame_width, frame_height, decoder, matcher_backend, cascade_k))
+
+    bounds = segment_bounds(total_frames, n_segments)
+    segments = []
+    with ProcessPoolExecutor(max_workers=n_segments) as pool:
+        futures = [
+            pool.submit(analyze_segment, video_path, bounds[k], bounds[k + 1], overlap,
+                        matcher_backend, diff_gate, settle_frames, use_template_cache, line_cache_spec(line_cache),
+                        decoder, profiler.enabled, source_options, cascade_k, buffer_pool, vote_frames, min_confidence)
+            for k in range(n_segments)
+        ]
+        try:
+            for k, future in enumerate(futures):
+                records, cache_stats, profile = future.result()
+                if cache_stats:
+                    line_cache.stats.update(cache_stats)
+                merge_profile(profile)
+                print(f"Segment {k + 1}/{n_segments}: frames {bounds[k]}-{bounds[k + 1] or total_frames} ({len(records)} relics)")
+                segments.append((bounds[k], records))
+        except KeyboardInterrupt:
+            print("Interrupted by user.")
+            for future in futures:
+                future.cancel()
+
+    if line_cache is not None:
+        line_cache.report()
+        count_line_cache_stats(line_cache)
+    return merge_segment_records(segments, confidence_columns)
+
+
+# === 複数動画の一括解析(--batch) ===
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".avi", ".webm")
+
+
+def list_batch_videos(inputs):
+    """ディレクトリ・動画ファイル・動画パスを1行ずつ書いたテキストファイルから、動画パスの一覧を作る"""
+    videos = []
+    for path in inputs:
+        if os.path.isdir(path):
+            videos += sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(VIDEO_EXTENSIONS)
+            )
+        elif path.lower().endswith(".txt"):
+            with open(path, encoding="utf-8") as f:
+                videos += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        else:
+            videos.append(path)
+    return list(dict.fromkeys(videos))
+
+
+def batch_csv_paths(videos, directory):
+    """動画ごとの CSV パス。ファイル名が重複する場合は連番を付ける"""
+    paths, used = [], set()
+    for video in videos:
+        stem = os.path.splitext(os.path.basename(video))[0]
+        name, n = stem, 1
+        while name in used:
+            n += 1
+            name = f"{stem}_{n}"
+        used.add(name)
+        paths.append(os.path.join(directory, f"{name}.csv"))
+    return paths
+
+
+_batch_state = {}
+
 
+def init_batch_worker(use_template_cache, use_line_cache):
+    """ワーカープロセスごとに1度だけテンプレートを読み込み、担当する全動画で使い回す"""
+    _batch_state["templates"] = load_template_bank() if use_template_cache else load_labeled_templates()
+    _batch_state["line_cache"] = LineCache() if use_line_cache else None
+
+
+def analyze_video_file(video_path, csv_path, options):
+    """動画1本を解析して csv_path に書き込み、マニフェスト用の情報を返す
+
+    解析中の出力は CSV と同じ名前の .log に書き込む。
+    """
+    started = time.perf_counter()
+    log_path = os.path.splitext(csv_path)[0] + ".log"
+    entry = {"video": video_path, "csv": csv_path, "log": log_path, "pid": os.getpid()}
+    line_cache = _batch_state["line_cache"]
+    if line_cache is not None:
+        # キャッシュの内容は動画をまたいで使い回し、ヒット数などのカウンタは動画ごとに数え直す
+        line_cache.take_stats()
+    try:
+        with open(log_path, "w", encoding="utf-8") as log_file:
+            def log(*values):
+                print(*values, file=log_file)
+
+            cap = open_relic_source(
+                video_path, options["frame_source"], options["scale"], options["crop_panel"], log=log,
+            )
+            try:
+                ret, frame = cap.read()
+                if not ret:
+                    raise ValueError(f"動画が読み込めません: {video_path}")
+                video_info = {"frames": int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), "frame_size": list(cap.full_size)}
+                header = csv_header(options["confidence_columns"])
+                with StreamingCsvWriter(csv_path, video_info, header=header) as output:
+                    analyze_relics(
+                        cap, frame, _batch_state["templates"], options["matcher"], options["diff_gate"],
+                        options["settle_frames"], line_cache=line_cache, decoder=options["decoder"],
+                        cascade_k=options["cascade_k"], buffer_pool=options["buffer_pool"],
+                        vote_frames=options["vote_frames"], min_confidence=options["min_confidence"],
+                        confidence_columns=options["confidence_columns"], output=output, show_progress=False, log=log,
+                    )
+                    entry["rows"] = output.rows
+            finally:
+                cap.release()
+        entry.update(status="ok", frames=video_info["frames"], frame_size=video_info["frame_size"])
+    except Exception as e:
+        entry.update(status="error", error=f"{type(e).__name__}: {e}")
+    entry["seconds"] = time.perf_counter() - started
+    if entry["status"] == "ok" and entry["seconds"] > 0:
+        entry["frames_per_second"] = entry["frames"] / entry["seconds"]
+    return entry
+
+
+def analyze_batch(inputs, directory, jobs, options, use_template_cache=True, use_line_cache=True):
+    """複数の動画を jobs 個のワーカープロセスで並行して解析し、動画ごとの CSV と manifest.json を directory に書き込む"""
+    videos = list_batch_videos(inputs)
+    if not videos:
+        print(f"⚠️ 解析する動画が見つかりません: {' '.join(inputs)}")
+        return None
+    os.makedirs(directory, exist_ok=True)
+    csv_paths = batch_csv_paths(videos, directory)
+    jobs = max(1, min(jobs, len(videos)))
+    print(f"Batch: {len(videos)} videos, {jobs} jobs -> {directory}")
+
+    started = time.perf_counter()
+    init_args = (use_template_cache, use_line_cache)
+    entries = [None] * len(videos)
+
+    def report(k, entry):
+        entries[k] = entry
+        done = sum(e is not None for e in entries)
+        name = os.path.basename(entry["video"])
+        if entry["status"] == "ok":
+            print(f"[{done}/{len(videos)}] {name}: {entry['rows']} rows ({entry['seconds']:.1f}s)")
+        else:
+            print(f"[{done}/{len(videos)}] {name}: ❌ {entry['error']}")
+
+    try:
+        if jobs == 1:
+            init_batch_worker(*init_args)
+            for k, (video, csv_path) in enumerate(zip(videos, csv_paths)):
+                report(k, analyze_video_file(video, csv_path, options))
+        else:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_batch_worker, initargs=init_args) as pool:
+                futures = {
+                    pool.submit(analyze_video_file, video, csv_path, options): k
+                    for k, (video, csv_path) in enumerate(zip(videos, csv_paths))
+                }
+                try:
+                    for future in as_completed(futures):
+                        report(futures[future], future.result())
+                except KeyboardInterrupt:
+                    for future in futures:
+                        future.cancel()
+                    raise
     except KeyboardInterrupt:
         print("Interrupted by user.")
 
-    return rows
+    wall = time.perf_counter() - started
+    done = [e for e in entries if e is not None]
+    manifest = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "jobs": jobs,
+        "options": options,
+        "wall_seconds": wall,
+        "videos": len(videos),
+        "succeeded": sum(e["status"] == "ok" for e in done),
+        "failed": sum(e["status"] != "ok" for e in done),
+        "rows": sum(e.get("rows", 0) for e in done),
+        "frames_per_second": sum(e.get("frames", 0) for e in done) / wall if wall > 0 else None,
+        "files": [e for e in entries if e is not None],
+    }
+    manifest_path = os.path.join(directory, "manifest.json")
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"✅ Manifest saved: {manifest_path} ({manifest['succeeded']}/{len(videos)} videos, {wall:.1f}s)")
+    return manifest
+
+
+# === コマンドライン引数 ===
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="遺物儀式画面の動画から遺物一覧CSVを作成")
+    parser.add_argument(
+        "--video", default=VIDEO_PATH,
+        help="解析する動画、またはスクリーンショット(PNG/JPG)を置いたディレクトリ (default: relics.mp4)",
+    )
+    parser.add_argument(
+        "--frame-source", choices=FRAME_SOURCES, default="auto",
+        help="フレームの読み込み方法。ffmpeg は ffmpeg の rawvideo 出力をパイプで受け取る。"
+             "auto はディレクトリなら images、それ以外は opencv (default: auto)",
+    )
+    parser.add_argument(
+        "--scale", type=parse_size, metavar="WIDTHxHEIGHT",
+        help="読み込み時にフレームをこのサイズに拡大縮小する(ffmpeg はデコード時に行う)",
+    )
+    parser.add_argument(
+        "--crop-panel", action="store_true",
+        help="遺物パネルの範囲だけを読み込む(ffmpeg はデコード時に切り出す)",
+    )
+    parser.add_argument(
+        "--buffer-pool", action="store_true",
+        help="デコード・縮小・差分判定の配列を使い回し、終了時にバッファの大きさと最大常駐メモリを表示する",
+    )
+    parser.add_argument(
+        "--matcher", choices=sorted(MATCHER_BACKENDS), default=DEFAULT_MATCHER_BACKEND,
+        help=f"文字照合バックエンド。cascade は縮小画像で候補を絞ってから照合する。"
+             f"bitset は二値化したビット列のハミング距離で照合する (default: {DEFAULT_MATCHER_BACKEND})",
+    )
+    parser.add_argument(
+        "--cascade-k", type=int, default=DEFAULT_CASCADE_K, metavar="K",
+        help=f"--matcher cascade で照合に残す候補数 (default: {DEFAULT_CASCADE_K})",
+    )
+    parser.add_argument(
+        "--decoder", choices=["scan", "trie"], default=DEFAULT_DECODER,
+        help="効果文の文字照合方式。trie は効果文の語彙で次の文字候補を絞り込む (default: scan)",
+    )
+    parser.add_argument(
+        "--diff-gate", choices=["roi", "frame"], default=DEFAULT_DIFF_GATE,
+        help=f"フレーム差分の判定方式 (default: {DEFAULT_DIFF_GATE})",
+    )
+    parser.add_argument(
+        "--settle-frames", type=int, default=DEFAULT_SETTLE_FRAMES,
+        help=f"パネルが N フレーム静止してから遺物1件につき1回だけ認識する。0 で変化したフレームを毎回認識 (default: {DEFAULT_SETTLE_FRAMES})",
+    )
+    parser.add_argument(
+        "--vote-frames", type=int, default=DEFAULT_VOTE_FRAMES, metavar="N",
+        help=f"確信度の低い項目を、同じ遺物を表示している後続の最大 N フレームでも認識して多数決で決める。0 で読み直さない (default: {DEFAULT_VOTE_FRAMES})",
+    )
+    parser.add_argument(
+        "--min-confidence", type=float, default=DEFAULT_MIN_CONFIDENCE,
+        help=f"この確信度(0〜1)未満の項目を読み直し、読み直しても下回れば警告を表示する (default: {DEFAULT_MIN_CONFIDENCE})",
+    )
+    parser.add_argument(
+        "--confidence-columns", action="store_true",
+        help="CSV の末尾に遺物名・効果・デメリットごとの確信度の列を加える",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="認識ワーカープロセス数。2以上でデコードと認識を並列化 (default: 1)",
+    )
+    parser.add_argument(
+        "--segments", type=int, default=1,
+        help="動画を N 区間に分割し、区間ごとに別プロセスでデコード・認識する (default: 1)",
+    )
+    parser.add_argument(
+        "--segment-overlap", type=int, default=SEGMENT_OVERLAP_FRAMES,
+        help=f"区間の開始位置より前から読み込むフレーム数 (default: {SEGMENT_OVERLAP_FRAMES})",
+    )
+    parser.add_argument(
+        "--no-line-cache", action="store_true",
+        help="行画像の認識キャッシュを使わない",
+    )
+    parser.add_argument(
+        "--line-cache-file",
+        help="行画像の認識キャッシュを保存/再利用するファイル。同じ解像度・テンプレートの実行間で再利用する",
+    )
+    parser.add_argument(
+        "--no-template-cache", action="store_true",
+        help="テンプレートキャッシュを使わず labeled_chars を毎回読み込む",
+    )
+    parser.add_argument(
+        "--batch", nargs="+", metavar="INPUT",
+        help="複数の動画を一括解析する。動画ファイル、動画を置いたディレクトリ、動画パスを1行ずつ書いた .txt を指定",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count() or 1,
+        help="--batch で同時に解析する動画数(ワーカープロセス数) (default: CPU コア数)",
+    )
+    parser.add_argument(
+        "--since", metavar="CSV",
+        help="前回作成した CSV。動画先頭の新しい遺物だけを解析し、既知の遺物に到達したら打ち切って結合した CSV を出力する",
+    )
+    parser.add_argument(
+        "--resume", nargs="?", const=True, metavar="CSV",
+        help="中断した解析をチェックポイントから再開し、CSV に追記する。CSV 省略時は output 内の最新のもの",
+    )
+    parser.add_argument(
+        "--profile", nargs="?", const=TRACE_PATH, metavar="TRACE_JSON",
+        help=f"処理区間とカウンタを記録し、Chrome trace 形式の JSON と集計表を出力する (default: {TRACE_PATH})",
+    )
+    args = parser.parse_args(argv)
+    if args.resume and args.segments > 1:
+        parser.error("--resume は --segments と同時に指定できません")
+    if args.since and (args.resume or args.segments > 1):
+        parser.error("--since は --resume/--segments と同時に指定できません")
+    if args.batch and (args.since or args.resume or args.profile or args.segments > 1 or args.workers > 1):
+        parser.error("--batch は --since/--resume/--profile/--segments/--workers と同時に指定できません")
+    return args
 
 
 # === メイン処理 ===
 def main():
+    args = parse_args()
+    if args.profile:
+        enable_profiler()
     print("遺物儀式画面の動画から遺物一覧CSVを作成します。100%の精度ではないため抽出漏れや解析誤りなどの可能性があります。")
 
+    if args.batch:
+        options = {
+            "matcher": args.matcher, "decoder": args.decoder, "cascade_k": args.cascade_k,
+            "diff_gate": args.diff_gate, "settle_frames": args.settle_frames,
+            "frame_source": args.frame_source, "scale": args.scale, "crop_panel": args.crop_panel,
+            "buffer_pool": args.buffer_pool, "vote_frames": args.vote_frames, "min_confidence": args.min_confidence,
+            "confidence_columns": args.confidence_columns,
+        }
+        batch_dir = os.path.join(output_dir, f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        analyze_batch(args.batch, batch_dir, args.jobs, options, not args.no_template_cache, not args.no_line_cache)
+        return
+
+    csv_path, resume = CSV_PATH, None
+    if args.resume:
+        csv_path = find_latest_checkpoint(output_dir) if args.resume is True else args.resume
+        resume = load_checkpoint(csv_path) if csv_path else None
+        if resume is None:
+            print(f"⚠️ 再開できるチェックポイントが見つかりません: {csv_path or output_dir}")
+            return
+
     # labeled_chars 読み込み
-    templates = load_labeled_templates()
+    templates = load_labeled_templates() if args.no_template_cache else load_template_bank()
 
     # 動画読み込み
-    cap = cv2.VideoCapture(VIDEO_PATH)
+    source_options = {"frame_source": args.frame_source, "scale": args.scale, "crop_panel": args.crop_panel}
+    cap = open_relic_source(args.video, **source_options)
     ret, frame = cap.read()
     if not ret:
         print("動画が読み込めません。実行ファイルと同じフォルダ(ディレクトリ)に relics.mp4 を配置してください。")
         return
 
-    rows = analyze_relics(cap, frame, templates)
-    cap.release()
-    save_csv(rows, CSV_PATH)
-    print(f"✅ CSV saved: {CSV_PATH} ({len(rows)} rows)")
+    video_info = {"frames": int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), "frame_size": list(cap.full_size)}
+    if resume is not None and resume["video"] != video_info:
+        print(f"⚠️ チェックポイントと動画のフレーム数/サイズが一致しません: {csv_path}")
+        return
+    header = csv_header(args.confidence_columns)
+    if resume is not None and load_csv_header(csv_path) != header:
+        print(f"⚠️ CSV の列が一致しません(--confidence-columns の指定を前回と揃えてください): {csv_path}")
+        return
+    if args.since and load_csv_header(args.since) != header:
+        # 既存CSVの行はそのまま結合するため、列が違うと行ごとに列数の異なる CSV になる
+        print(f"⚠️ --since の CSV と列が一致しません(--confidence-columns の指定を既存CSVと揃えてください): {args.since}")
+        return
+    confidence_options = {
+        "vote_frames": args.vote_frames, "min_confidence": args.min_confidence,
+        "confidence_columns": args.confidence_columns,
+    }
+
+    line_cache = None if args.no_line_cache else LineCache(path=args.line_cache_file)
+    if args.since:
+        known = KnownRelics(load_csv_rows(args.since))
+        rows = analyze_relics(
+            cap, frame, templates, args.matcher, args.diff_gate, args.settle_frames,
+            workers=args.workers, use_template_cache=not args.no_template_cache, line_cache=line_cache,
+            decoder=args.decoder, known=known, cascade_k=args.cascade_k, buffer_pool=args.buffer_pool,
+            **confidence_options,
+        )
+        cap.release()
+        rows = known.merge(rows)
+        save_csv(rows, csv_path, header)
+        n_rows = len(rows)
+    elif args.segments > 1:
+        cap.release()
+        rows = analyze_relics_segmented(
+            args.video, args.segments, args.segment_overlap, args.matcher, args.diff_gate, args.settle_frames,
+            use_template_cache=not args.no_template_cache, line_cache=line_cache, decoder=args.decoder,
+            source_options=source_options, cascade_k=args.cascade_k, buffer_pool=args.buffer_pool,
+            **confidence_options,
+        )
+        save_csv(rows, csv_path, header)
+        n_rows = len(rows)
+    else:
+        # 行が確定するたびに CSV に書き込み、異常終了しても --resume で続きから解析できるようにする
+        with StreamingCsvWriter(csv_path, video_info, resume, header) as output:
+            analyze_relics(
+                cap, frame, templates, args.matcher, args.diff_gate, args.settle_frames,
+                workers=args.workers, use_template_cache=not args.no_template_cache, line_cache=line_cache,
+                decoder=args.decoder, output=output, resume=resume, cascade_k=args.cascade_k,
+                buffer_pool=args.buffer_pool, **confidence_options,
+            )
+            n_rows = output.rows
+        cap.release()
+    print(f"✅ CSV saved: {csv_path} ({n_rows} rows)")
+    if args.profile:
+        profiler.export(args.profile)
+        profiler.report()
+        print(f"✅ Trace saved: {args.profile}")
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,571 @@
+import argparse
+import contextlib
+import csv
+import io
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+import analyze_relics as ar
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+SAMPLE_VIDEO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "relics_sample.mp4")
+GOLDEN_CSV_PATH = os.path.join(BENCH_DIR, "relics_sample.csv")
+RESULT_PATH = os.path.join(BENCH_DIR, "last_run.json")
+
+STAGES = ["decode", "diff_gate", "name_recognition", "effect_recognition", "find_closest_effect", "csv_write"]
+CSV_FIELDS = ["Name", "Color", "Effect1", "Effect2", "Effect3", "Disadvantage1", "Disadvantage2", "Disadvantage3"]
+
+DEFAULT_REPEAT = 3
+DEFAULT_MAX_REGRESSION = 0.2
+# これより短いステージは計測誤差が大きいので速度の退行判定から外す
+REGRESSION_MIN_SECONDS = 0.05
+MICRO_MIN_SECONDS = 0.2
+DEFAULT_FRAME_CHECK_SEGMENTS = 3
+# 照合結果を match_best_char と比べる解像度(認識解像度の 1080p 以外)
+DEFAULT_AGREEMENT_SCALES = "1280x720,3840x2160"
+
+
+# === ステージ別の計測 ===
+class StageTimer:
+    """ステージごとの経過時間と呼び出し回数を集計する"""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+                self.calls[stage] += 1
+        return timed
+
+
+class TimedCapture:
+    """cap.read() の時間を decode として計測する"""
+
+    def __init__(self, cap, timer):
+        self._cap = cap
+        self.read = timer.wrap("decode", cap.read)
+
+    def __getattr__(self, name):
+        return getattr(self._cap, name)
+
+
+class TimedGate:
+    """差分判定 (feed/flush) の時間を diff_gate として計測する"""
+
+    def __init__(self, gate, timer):
+        self._gate = gate
+        self.feed = timer.wrap("diff_gate", gate.feed)
+        self.flush = timer.wrap("diff_gate", gate.flush)
+
+    def __getattr__(self, name):
+        return getattr(self._gate, name)
+
+
+@contextlib.contextmanager
+def instrumented(timer):
+    """analyze_relics モジュールの各ステージを計測用の関数に差し替える"""
+    originals = {name: getattr(ar, name) for name in ("create_gate", "recognize_text", "find_closest_effect")}
+    name_text = timer.wrap("name_recognition", originals["recognize_text"])
+    effect_text = timer.wrap("effect_recognition", originals["recognize_text"])
+
+    def recognize_text(line_img, labeled_dict, char_width, n_chars=40, matcher=None, cache=None, cache_tag=""):
+        timed = name_text if cache_tag == "name" else effect_text
+        return timed(line_img, labeled_dict, char_width, n_chars, matcher, cache, cache_tag)
+
+    ar.create_gate = lambda *args, **kwargs: TimedGate(originals["create_gate"](*args, **kwargs), timer)
+    ar.recognize_text = recognize_text
+    ar.find_closest_effect = timer.wrap("find_closest_effect", originals["find_closest_effect"])
+    try:
+        yield
+    finally:
+        for name, func in originals.items():
+            setattr(ar, name, func)
+
+
+def run_pipeline(video_path, templates, args):
+    """サンプル動画を1回解析し、(行リスト, 全体の秒数, StageTimer, フレーム数) を返す"""
+    timer = StageTimer()
+    line_cache = None if args.no_line_cache else ar.LineCache()
+    cap = ar.open_relic_source(video_path)
+    ret, frame = cap.read()
+    if not ret:
+        raise SystemExit(f"動画が読み込めません: {video_path}")
+
+    start = time.perf_counter()
+    with instrumented(timer), contextlib.redirect_stdout(io.StringIO()):
+        rows = ar.analyze_relics(
+            TimedCapture(cap, timer), frame, templates, args.matcher, args.diff_gate, args.settle_frames,
+            line_cache=line_cache, decoder=args.decoder, cascade_k=args.cascade_k, buffer_pool=args.buffer_pool,
+            vote_frames=args.vote_frames, min_confidence=args.min_confidence, confidence_columns=True,
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            timer.wrap("csv_write", ar.save_csv)(rows, os.path.join(tmp_dir, "relics.csv"), ar.csv_header(True))
+    wall = time.perf_counter() - start
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return rows, wall, timer, frames
+
+
+def summarize_stages(runs):
+    """各ステージは複数回の実行のうち最短の時間を採用する"""
+    stages = {}
+    for stage in STAGES:
+        seconds = min(timer.seconds[stage] for _, _, timer, _ in runs)
+        calls = runs[0][2].calls[stage]
+        stages[stage] = {
+            "seconds": seconds,
+            "calls": calls,
+            "calls_per_second": calls / seconds if seconds > 0 else None,
+        }
+    return stages
+
+
+# === 正解CSVとの比較 ===
+def load_golden(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader)
+        return [row[1:] for row in reader]
+
+
+def compare_rows(rows, golden, min_confidence=ar.DEFAULT_MIN_CONFIDENCE):
+    """正解CSVと行番号順に比較し、項目ごとの正解率を返す
+
+    行に確信度の列があれば、不一致の項目に確信度を添え、確信度が min_confidence 未満の項目数を数える。
+    """
+    actual = [[str(value) for value in row[1:len(ar.CSV_HEADER)]] for row in rows]
+    confidences = [dict(zip(ar.CONFIDENCE_HEADER, map(float, row[len(ar.CSV_HEADER):]))) for row in rows]
+    n_rows = max(len(actual), len(golden))
+    fields = {}
+    mismatches = []
+    for col, field in enumerate(CSV_FIELDS):
+        correct = 0
+        for i in range(n_rows):
+            got = actual[i][col] if i < len(actual) else None
+            want = golden[i][col] if i < len(golden) else None
+            if got == want:
+                correct += 1
+            else:
+                mismatch = {"no": i + 1, "field": field, "expected": want, "actual": got}
+                confidence = confidences[i].get(f"{field}Confidence") if i < len(confidences) else None
+                if confidence is not None:
+                    mismatch["confidence"] = confidence
+                mismatches.append(mismatch)
+        fields[field] = correct / n_rows if n_rows else 1.0
+    total = n_rows * len(CSV_FIELDS)
+    return {
+        "rows": len(actual),
+        "expected_rows": len(golden),
+        "field_accuracy": fields,
+        "accuracy": (total - len(mismatches)) / total if total else 1.0,
+        "exact_rows": sum(1 for a, g in zip(actual, golden) if a == g),
+        "low_confidence_fields": sum(1 for c in confidences for value in c.values() if value < min_confidence),
+        "mismatches": mismatches,
+    }
+
+
+# === マイクロベンチマーク ===
+def time_call(func, min_seconds=MICRO_MIN_SECONDS):
+    """min_seconds 以上繰り返して1回あたりの平均秒数を返す"""
+    func()
+    loops = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        loops += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return {"seconds_per_call": elapsed / loops, "loops": loops}
+
+
+def sample_panel(video_path, frame_idx):
+    """差分判定と同じ切り出しで frame_idx のパネル画像と layout を返す"""
+    cap = cv2.VideoCapture(video_path)
+    # 解析の前に位置 0 のフレームを読むため、フレーム番号 N は位置 N のフレーム
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+    ret, frame = cap.read()
+    cap.release()
+    if not ret:
+        raise SystemExit(f"フレーム {frame_idx} が読み込めません: {video_path}")
+    h, w = frame.shape[:2]
+    layout = ar.build_relic_layout(w, h)
+    r = layout["diff_region"]
+    gray = cv2.cvtColor(frame[r["y1"]:r["y2"], r["x1"]:r["x2"]], cv2.COLOR_BGR2GRAY)
+    return ar.normalize_panel(gray, layout), layout
+
+
+def run_micro_benchmarks(video_path, templates, args):
+    gray, layout = sample_panel(video_path, args.micro_frame)
+    rois = layout["panel_rois"]
+    effect_width = layout["effect_char_width"]
+    line_img = ar.crop_region(gray, rois["effect1_1"], "effect1_1")
+    cell = ar.preprocess(line_img)[:, :math.ceil(effect_width)]
+    cells = ar.segment_glyphs(ar.preprocess(line_img), effect_width, ar.RELIC_EFFECT_CHARS)
+    effect_dict = templates["effect"]
+    matchers = ar.create_matchers(templates, args.matcher, args.decoder, args.cascade_k)
+
+    return {
+        "match_best_char": time_call(lambda: ar.match_best_char(cell, effect_dict)),
+        # 1行分のセルを --matcher の照合バックエンドで照合する(--matcher を変えた結果を --baseline で比較できる)
+        "match_cells": time_call(lambda: list(matchers["effect"].match_cells(cells))),
+        "recognize_text": time_call(
+            lambda: ar.recognize_text(line_img, None, effect_width, ar.RELIC_EFFECT_CHARS, matchers["effect"])
+        ),
+        "load_labeled_templates": time_call(ar.load_labeled_templates),
+        "load_template_bank": time_call(ar.load_template_bank),
+    }
+
+
+# === テンプレート自身の照合 ===
+def check_template_self_match(templates, args):
+    """各テンプレートをセルとして --matcher と match_best_char で照合し、文字が食い違ったものを返す
+
+    テンプレートと画素が一致するセルは満点除外ルール(IGNORE_FULLSCORE_CHARS)の境界になるため、近似するバックエンドの確認に使う。
+    """
+    matchers = ar.create_matchers(templates, args.matcher, "scan", args.cascade_k)
+    result = {}
+    for kind, labeled_dict in templates.items():
+        cells = [tmpl for samples in labeled_dict.values() for tmpl in samples]
+        labels = [ch.replace("\r", "") for ch, samples in labeled_dict.items() for _ in samples]
+        actual = list(matchers[kind].match_cells(cells))
+        expected = [ar.match_best_char(cell, labeled_dict) for cell in cells]
+        result[kind] = {
+            "templates": len(cells),
+            "mismatches": [
+                {"template": label, "expected": e[0], "actual": a[0]}
+                for label, e, a in zip(labels, expected, actual) if e[0] != a[0]
+            ],
+        }
+    return result
+
+
+# === 解像度ごとの照合結果の確認 ===
+def sample_lines(video_path, scale, args):
+    """scale で読み込んだ動画の、差分判定を通過したパネルの各行を (種類, 文字のあるセルのリスト) で返す"""
+    cap = ar.open_relic_source(video_path, scale=scale)
+    ret, frame = cap.read()
+    if not ret:
+        raise SystemExit(f"動画が読み込めません: {video_path}")
+    layout = ar.build_relic_layout(*cap.full_size)
+    gate = ar.create_gate(layout["diff_region"], args.diff_gate, args.settle_frames)
+    lines = []
+    for _, gray, _ in ar.iter_changed_panels(cap, gate, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), show_progress=False):
+        gray = ar.normalize_panel(gray, layout)
+        for key, rect in layout["panel_rois"].items():
+            line_img = ar.crop_region(gray, rect, key)
+            if ar.is_blank_line(line_img):
+                continue
+            if key == "name":
+                lines.append(("name", ar.segment_glyphs(ar.preprocess(line_img), layout["name_width"], 1)))
+            else:
+                cells = ar.segment_glyphs(ar.preprocess(line_img), layout["effect_char_width"], ar.RELIC_EFFECT_CHARS)
+                lines.append(("effect", cells))
+    cap.release()
+    return lines
+
+
+def check_matcher_agreement(video_path, templates, args):
+    """--agreement-scales の解像度で読み込んだ各セルを --matcher と match_best_char で照合し、食い違った数と1行あたりの時間を返す
+
+    認識は 1080p 相当に拡大縮小したパネルで行うため、1080p 以外の動画ではセルの画素がテンプレートから離れ、
+    候補を絞る・近似するバックエンドの結果が変わりやすい。
+    """
+    matchers = ar.create_matchers(templates, args.matcher, "scan", args.cascade_k)
+    result = {}
+    for scale in args.agreement_scales:
+        cells = mismatches = unmatched = 0
+        seconds = 0.0
+        lines = sample_lines(video_path, scale, args)
+        for kind, line_cells in lines:
+            start = time.perf_counter()
+            actual = list(matchers[kind].match_cells(line_cells))
+            seconds += time.perf_counter() - start
+            expected = [ar.match_best_char(cell, templates[kind]) for cell in line_cells]
+            cells += len(line_cells)
+            for a, e in zip(actual, expected):
+                if a[0] != e[0]:
+                    mismatches += 1
+                    unmatched += a[0] is None
+        result[f"{scale[0]}x{scale[1]}"] = {
+            "lines": len(lines), "cells": cells, "mismatches": mismatches, "unmatched": unmatched,
+            "seconds_per_line": seconds / len(lines) if lines else None,
+        }
+    return result
+
+
+# === フレーム番号の確認 ===
+class CheckpointRecorder:
+    """analyze_relics の output として、チェックポイントを保存したフレームとその時点の状態を記録する"""
+
+    def __init__(self, rows=0):
+        self.rows = rows
+        self.checkpoints = []
+
+    def write_row(self, row):
+        self.rows += 1
+
+    def save_checkpoint(self, frame_idx, last_name, last_effects):
+        self.checkpoints.append(
+            {"frame_idx": frame_idx, "last_name": last_name, "last_effects": last_effects, "rows": self.rows}
+        )
+
+    def complete(self):
+        pass
+
+
+def record_checkpoints(video_path, templates, args, resume=None):
+    """動画を解析し、認識したフレームごとのチェックポイントを返す"""
+    recorder = CheckpointRecorder(resume["rows"] if resume else 0)
+    cap = ar.open_relic_source(video_path)
+    ret, frame = cap.read()
+    if not ret:
+        raise SystemExit(f"動画が読み込めません: {video_path}")
+    ar.analyze_relics(
+        cap, frame, templates, args.matcher, args.diff_gate, args.settle_frames, line_cache=ar.LineCache(),
+        decoder=args.decoder, output=recorder, resume=resume, show_progress=False, cascade_k=args.cascade_k,
+        vote_frames=args.vote_frames, min_confidence=args.min_confidence, log=lambda *values: None,
+    )
+    cap.release()
+    return recorder.checkpoints
+
+
+def check_resume_frames(video_path, templates, args, full):
+    """途中のチェックポイントから --resume した解析が、中断しなかった解析と同じフレーム番号・行数で認識するかを返す"""
+    resume = full[len(full) // 2]
+    resumed = record_checkpoints(video_path, templates, args, resume)
+    expected = [(c["frame_idx"], c["rows"]) for c in full if c["frame_idx"] > resume["frame_idx"]]
+    actual = [(c["frame_idx"], c["rows"]) for c in resumed]
+    return {"resume_frame": resume["frame_idx"], "frames": len(expected), "agree": expected == actual,
+            "expected": [f for f, _ in expected], "actual": [f for f, _ in actual]}
+
+
+def check_segment_frames(video_path, args, full):
+    """--segments で区間ごとに解析して結合した各行が、逐次解析と同じフレーム番号で認識されるかを返す"""
+    cap = ar.open_relic_source(video_path)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    bounds = ar.segment_bounds(total_frames, args.frame_check_segments)
+    actual = []
+    last = None
+    # merge_segment_records と同じく、重複読み込みした部分と境界をまたいで続く遺物を除く
+    for start_frame, end_frame in zip(bounds, bounds[1:]):
+        records, _, _ = ar.analyze_segment(
+            video_path, start_frame, end_frame, ar.SEGMENT_OVERLAP_FRAMES, args.matcher, args.diff_gate,
+            args.settle_frames, True, decoder=args.decoder, cascade_k=args.cascade_k, vote_frames=args.vote_frames,
+            min_confidence=args.min_confidence,
+        )
+        for frame_idx, name_text, _, effects, _, _ in records:
+            if frame_idx < start_frame or (name_text, effects) == last:
+                continue
+            actual.append(frame_idx)
+            last = (name_text, effects)
+    rows = [0] + [c["rows"] for c in full]
+    expected = [c["frame_idx"] for c, prev in zip(full, rows) if c["rows"] > prev]
+    return {"segments": args.frame_check_segments, "frames": len(expected), "agree": expected == actual,
+            "expected": expected, "actual": actual}
+
+
+def check_frame_labels(video_path, templates, args):
+    full = record_checkpoints(video_path, templates, args)
+    return {
+        "resume": check_resume_frames(video_path, templates, args, full),
+        "segments": check_segment_frames(video_path, args, full),
+    }
+
+
+# === 前回結果との比較 ===
+def find_regressions(result, baseline, max_regression, min_accuracy):
+    """速度・精度の退行を文字列のリストで返す"""
+    problems = []
+    if result["accuracy"]["accuracy"] < min_accuracy:
+        problems.append(f"accuracy {result['accuracy']['accuracy']:.4f} < {min_accuracy:.4f}")
+    for kind, value in result.get("self_match", {}).items():
+        if value["mismatches"]:
+            problems.append(f"self_match.{kind} {len(value['mismatches'])}/{value['templates']} templates differ from loop")
+    for scale, value in result.get("agreement", {}).items():
+        if value["mismatches"]:
+            problems.append(f"agreement.{scale} {value['mismatches']}/{value['cells']} cells differ from loop "
+                            f"({value['unmatched']} unmatched)")
+    resume = result.get("frame_labels", {}).get("resume")
+    if resume and not resume["agree"]:
+        problems.append(f"resume from frame {resume['resume_frame']} recognizes frames {resume['actual'][:5]}..., "
+                        f"expected {resume['expected'][:5]}...")
+    segments = result.get("frame_labels", {}).get("segments")
+    if segments and not segments["agree"]:
+        problems.append(f"--segments {segments['segments']} recognizes frames {segments['actual'][:5]}..., "
+                        f"expected {segments['expected'][:5]}...")
+    if baseline is None:
+        return problems
+
+    if result["accuracy"]["accuracy"] < baseline["accuracy"]["accuracy"]:
+        problems.append(
+            f"accuracy {result['accuracy']['accuracy']:.4f} < baseline {baseline['accuracy']['accuracy']:.4f}"
+        )
+    timings = [("wall", result["wall_seconds"], baseline["wall_seconds"])]
+    timings += [
+        (stage, result["stages"][stage]["seconds"], baseline["stages"][stage]["seconds"])
+        for stage in STAGES if stage in baseline.get("stages", {})
+    ]
+    timings += [
+        (f"micro.{name}", value["seconds_per_call"], baseline["micro"][name]["seconds_per_call"])
+        for name, value in result.get("micro", {}).items() if name in baseline.get("micro", {})
+    ]
+    for name, current, previous in timings:
+        if not name.startswith("micro.") and max(current, previous) < REGRESSION_MIN_SECONDS:
+            continue
+        if current > previous * (1 + max_regression):
+            problems.append(f"{name} {current:.4f}s > baseline {previous:.4f}s (+{(current / previous - 1) * 100:.1f}%)")
+    return problems
+
+
+def print_report(result):
+    print(f"Video: {result['video']} ({result['frames']} frames)")
+    print(f"Wall: {result['wall_seconds']:.3f}s ({result['frames'] / result['wall_seconds']:.1f} frames/s)")
+    for stage in STAGES:
+        s = result["stages"][stage]
+        rate = f"{s['calls_per_second']:.1f}/s" if s["calls_per_second"] else "-"
+        print(f"  {stage:<20} {s['seconds']:8.3f}s  calls={s['calls']:<6} {rate}")
+    if result.get("peak_rss_bytes"):
+        print(f"Peak RSS: {result['peak_rss_bytes'] / 2**20:.0f}MB")
+    acc = result["accuracy"]
+    print(f"Accuracy: {acc['accuracy'] * 100:.2f}% (rows {acc['rows']}/{acc['expected_rows']}, exact rows {acc['exact_rows']})")
+    for field, value in acc["field_accuracy"].items():
+        print(f"  {field:<20} {value * 100:6.2f}%")
+    print(f"  low confidence fields {acc['low_confidence_fields']}")
+    for m in acc["mismatches"]:
+        confidence = f" confidence={m['confidence']:.3f}" if "confidence" in m else ""
+        print(f"  ✗ No.{m['no']} {m['field']}: expected={m['expected']!r} actual={m['actual']!r}{confidence}")
+    for kind, value in result.get("self_match", {}).items():
+        agree = value["templates"] - len(value["mismatches"])
+        print(f"Template self-match ({kind}): {agree}/{value['templates']} agree with loop")
+        for m in value["mismatches"]:
+            print(f"  ✗ {m['template']}: expected={m['expected']!r} actual={m['actual']!r}")
+    for scale, value in result.get("agreement", {}).items():
+        agree = value["cells"] - value["mismatches"]
+        ms = value["seconds_per_line"] * 1e3 if value["seconds_per_line"] is not None else 0.0
+        print(f"Agreement {scale}: {agree}/{value['cells']} cells agree with loop "
+              f"({value['unmatched']} unmatched, {ms:.3f} ms/line)")
+    resume = result.get("frame_labels", {}).get("resume")
+    if resume:
+        verdict = "✓ match" if resume["agree"] else "✗ differ from"
+        print(f"Resume from frame {resume['resume_frame']}: {resume['frames']} frames {verdict} uninterrupted run")
+    segments = result.get("frame_labels", {}).get("segments")
+    if segments:
+        verdict = "✓ match" if segments["agree"] else "✗ differ from"
+        print(f"Segments {segments['segments']}: {segments['frames']} relic frames {verdict} sequential run")
+    for name, value in result.get("micro", {}).items():
+        print(f"  micro {name:<24} {value['seconds_per_call'] * 1e3:10.3f} ms/call")
+
+
+def parse_scales(text):
+    return [ar.parse_size(size) for size in text.split(",")]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="relics_sample.mp4 でステージ別の処理時間と認識精度を計測")
+    parser.add_argument("--video", default=SAMPLE_VIDEO_PATH, help="計測に使う動画")
+    parser.add_argument("--golden", default=GOLDEN_CSV_PATH, help="正解CSV")
+    parser.add_argument("--output", default=RESULT_PATH, help=f"結果JSONの保存先 (default: {RESULT_PATH})")
+    parser.add_argument("--baseline", help="比較対象の結果JSON。退行があれば終了コード 1 で終了する")
+    parser.add_argument(
+        "--max-regression", type=float, default=DEFAULT_MAX_REGRESSION,
+        help=f"baseline に対して許容する処理時間の増加率 (default: {DEFAULT_MAX_REGRESSION})",
+    )
+    parser.add_argument("--min-accuracy", type=float, default=0.0, help="下回ると失敗とする項目単位の正解率")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help=f"解析の繰り返し回数 (default: {DEFAULT_REPEAT})")
+    parser.add_argument("--no-micro", action="store_true", help="マイクロベンチマークを実行しない")
+    parser.add_argument("--micro-frame", type=int, default=43, help="マイクロベンチマークに使うフレーム番号")
+    parser.add_argument(
+        "--no-self-match", action="store_true", help="テンプレート自身を --matcher と match_best_char で照合する確認を行わない",
+    )
+    parser.add_argument(
+        "--agreement-scales", type=parse_scales, default=DEFAULT_AGREEMENT_SCALES, metavar="WxH,...",
+        help=f"--matcher と match_best_char の結果を比べる読み込み解像度 (default: {DEFAULT_AGREEMENT_SCALES})",
+    )
+    parser.add_argument("--no-agreement", action="store_true", help="解像度ごとの照合結果の確認を行わない")
+    parser.add_argument(
+        "--no-frame-check", action="store_true",
+        help="--resume で再開した解析と --segments で分割した解析のフレーム番号を確認しない",
+    )
+    parser.add_argument(
+        "--frame-check-segments", type=int, default=DEFAULT_FRAME_CHECK_SEGMENTS,
+        help=f"フレーム番号を確認する区間数 (default: {DEFAULT_FRAME_CHECK_SEGMENTS})",
+    )
+    parser.add_argument("--matcher", choices=sorted(ar.MATCHER_BACKENDS), default=ar.DEFAULT_MATCHER_BACKEND)
+    parser.add_argument("--decoder", choices=["scan", "trie"], default=ar.DEFAULT_DECODER)
+    parser.add_argument("--cascade-k", type=int, default=ar.DEFAULT_CASCADE_K)
+    parser.add_argument("--diff-gate", choices=["roi", "frame"], default=ar.DEFAULT_DIFF_GATE)
+    parser.add_argument("--settle-frames", type=int, default=ar.DEFAULT_SETTLE_FRAMES)
+    parser.add_argument("--no-line-cache", action="store_true")
+    parser.add_argument("--buffer-pool", action="store_true", help="デコード・差分判定の配列を使い回す")
+    parser.add_argument("--vote-frames", type=int, default=ar.DEFAULT_VOTE_FRAMES)
+    parser.add_argument("--min-confidence", type=float, default=ar.DEFAULT_MIN_CONFIDENCE)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    templates = ar.load_template_bank()
+    runs = [run_pipeline(args.video, templates, args) for _ in range(max(1, args.repeat))]
+    rows = runs[0][0]
+
+    result = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "video": os.path.basename(args.video),
+        "options": {
+            "matcher": args.matcher, "decoder": args.decoder, "cascade_k": args.cascade_k, "diff_gate": args.diff_gate,
+            "settle_frames": args.settle_frames, "line_cache": not args.no_line_cache, "repeat": args.repeat,
+            "buffer_pool": args.buffer_pool, "vote_frames": args.vote_frames, "min_confidence": args.min_confidence,
+        },
+        "frames": runs[0][3],
+        "wall_seconds": min(wall for _, wall, _, _ in runs),
+        "stages": summarize_stages(runs),
+        "accuracy": compare_rows(rows, load_golden(args.golden), args.min_confidence),
+        "peak_rss_bytes": ar.peak_rss_bytes(),
+    }
+    if not args.no_self_match:
+        result["self_match"] = check_template_self_match(templates, args)
+    if not args.no_agreement:
+        result["agreement"] = check_matcher_agreement(args.video, templates, args)
+    if not args.no_frame_check:
+        result["frame_labels"] = check_frame_labels(args.video, templates, args)
+    if not args.no_micro:
+        result["micro"] = run_micro_benchmarks(args.video, templates, args)
+    print_report(result)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"✅ Result saved: {args.output}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    problems = find_regressions(result, baseline, args.max_regression, args.min_accuracy)
+    for problem in problems:
+        print(f"❌ Regression: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
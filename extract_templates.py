@@ -2,8 +2,11 @@ import cv2
 import numpy as np
 import os
 import math
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
+from frame_sources import normalized_size, open_frame_source, union_rect
+
 # === 設定 ===
 VIDEO_DIR = './videos/'
 OUTPUT_DIR = './labeled_chars/'
@@ -13,6 +16,13 @@ DIFF_SAVE_THRESHOLD_CHAR = 40
 CHAR_WIDTH_BASE = 40
 CALC_BASE_WIDTH = 3840
 CALC_BASE_HEIGHT = 2160
+FRAME_SOURCE = "auto"  # auto/opencv/ffmpeg/images (auto はディレクトリなら images、それ以外は opencv)
+FRAME_SCALE = None  # (幅, 高さ) を指定すると読み込み時に拡大縮小
+CROP_IN_DECODER = False  # True で遺物名/効果の範囲だけを読み込む(ffmpeg はデコード時に切り出す)
+TEMPLATE_HEIGHT = 1080  # FRAME_SCALE 未指定時はこの高さに揃えてから切り出す(analyze_relics.TEMPLATE_HEIGHT と同じ値)
+EFFECT_DIFF_TH = 0.5  # 効果欄の平均差分(間引いたグレースケール)がこれ以下のフレームは文字を切り出さない
+EFFECT_DIFF_STRIDE = 4
+WORKERS = os.cpu_count() or 1  # 動画を並列に処理するプロセス数
 
 # 保存ディレクトリ作成
 os.makedirs(os.path.join(OUTPUT_DIR, 'name'), exist_ok=True)
@@ -27,31 +37,145 @@ def preprocess_for_diff(img_gray):
     edge = cv2.Canny(img_gray, 50, 150)
     return edge
 
+# === 保存済み画像の索引 ===
+NOVELTY_GRID = (4, 4)  # 非0画素数を数えるブロックの分割数(縦, 横)
+NOVELTY_CHUNK = 8  # 差分画素数の下限が小さい順にまずこの枚数と比較し、一致しなければ残りをまとめて比較する
+_block_edges = {}
+
+
+def block_counts(img):
+    """img を NOVELTY_GRID のブロックに分け、ブロックごとの非0画素数を返す"""
+    edges = _block_edges.get(img.shape)
+    if edges is None:
+        h, w = img.shape
+        rows = np.linspace(0, h, min(NOVELTY_GRID[0], h) + 1).astype(int)[:-1]
+        cols = np.linspace(0, w, min(NOVELTY_GRID[1], w) + 1).astype(int)[:-1]
+        edges = _block_edges[img.shape] = (rows, cols)
+    rows, cols = edges
+    nonzero = (img != 0).astype(np.int32)
+    return np.add.reduceat(np.add.reduceat(nonzero, rows, axis=0), cols, axis=1).ravel()
+
+
+class ShapeBucket:
+    """同じサイズに揃えた保存済み画像と、その非0画素数・ブロックごとの非0画素数
+
+    order は非0画素数の昇順に並べた画像番号で、非0画素数が近い画像だけを二分探索で取り出すのに使う。
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.n = 0
+        self.images = np.zeros((16, *shape), dtype=np.uint8)
+        self.nonzero = np.zeros(16, dtype=np.int32)
+        self.blocks = np.zeros((16, len(block_counts(self.images[0]))), dtype=np.int32)
+        self.order = np.zeros(0, dtype=np.intp)
+        self.sorted_nonzero = np.zeros(0, dtype=np.int32)
+
+    def append(self, img):
+        if self.n == len(self.images):
+            self.images = np.concatenate([self.images, np.zeros_like(self.images)])
+            self.nonzero = np.concatenate([self.nonzero, np.zeros_like(self.nonzero)])
+            self.blocks = np.concatenate([self.blocks, np.zeros_like(self.blocks)])
+        self.images[self.n] = img
+        self.nonzero[self.n] = cv2.countNonZero(img)
+        self.blocks[self.n] = block_counts(img)
+        self.n += 1
+
+    def near(self, nonzero, distance):
+        """非0画素数の差が distance 未満の画像番号"""
+        if len(self.order) != self.n:
+            self.order = np.argsort(self.nonzero[:self.n], kind="stable")
+            self.sorted_nonzero = self.nonzero[self.order]
+        lo, hi = np.searchsorted(self.sorted_nonzero, [nonzero - distance + 1, nonzero + distance], side="left")
+        return self.order[lo:hi]
+
+
+class NoveltyIndex:
+    """保存済み画像(preprocess_for_diff 済み)の索引
+
+    is_new は「差分画素数が threshold 未満の保存済み画像が1枚も無い」ときに True を返す(全件と比較する場合と同じ判定)。
+    find はその場合に None、それ以外は一致した保存済み画像を add したときの key を返す。
+    2枚の差分画素数はブロックごとの非0画素数の差の合計以上になるため、その値が threshold 以上の画像とは比較しない。
+    サイズの異なる画像は従来どおり比較対象のサイズに INTER_AREA で縮小/拡大して比較し、縮小/拡大後の画像は使い回す。
+    """
+
+    def __init__(self, images=()):
+        self.saved = {}  # サイズ → 保存済み画像のリスト
+        self.keys = {}  # サイズ → saved と同じ並びの key のリスト
+        self.buckets = {}  # (保存時のサイズ, 比較対象のサイズ) → ShapeBucket
+        for img in images:
+            self.add(img)
+
+    def __len__(self):
+        return sum(len(imgs) for imgs in self.saved.values())
+
+    def add(self, img, key=None):
+        """img を追加する。key を省略した場合は追加した順の番号"""
+        self.keys.setdefault(img.shape, []).append(len(self) if key is None else key)
+        self.saved.setdefault(img.shape, []).append(img)
+
+    def _bucket(self, shape, target_shape):
+        key = (shape, target_shape)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = ShapeBucket(target_shape)
+        # 前回以降に追加された画像を比較対象のサイズにして追加する
+        for img in self.saved[shape][bucket.n:]:
+            if shape != target_shape:
+                img = cv2.resize(img, (target_shape[1], target_shape[0]), interpolation=cv2.INTER_AREA)
+            bucket.append(img)
+        return bucket
+
+    def is_new(self, img_proc, diff_save_threshold):
+        return self.find(img_proc, diff_save_threshold) is None
+
+    def find(self, img_proc, diff_save_threshold):
+        nonzero = cv2.countNonZero(img_proc)
+        blocks = None
+        # 同じサイズの画像から調べる
+        shapes = sorted(self.saved, key=lambda shape: shape != img_proc.shape)
+        for shape in shapes:
+            bucket = self._bucket(shape, img_proc.shape)
+            candidates = bucket.near(nonzero, diff_save_threshold)
+            if len(candidates) == 0:
+                continue
+            if blocks is None:
+                blocks = block_counts(img_proc)
+            bound = np.abs(bucket.blocks[candidates] - blocks).sum(axis=1)
+            candidates = candidates[bound < diff_save_threshold]
+            bound = bound[bound < diff_save_threshold]
+            if len(candidates) > NOVELTY_CHUNK:
+                # 下限が小さい(似ている可能性が高い)画像から先に比較し、見つかれば残りは比較しない
+                first = np.argpartition(bound, NOVELTY_CHUNK)[:NOVELTY_CHUNK]
+                diff = np.count_nonzero(bucket.images[candidates[first]] != img_proc, axis=(1, 2))
+                if (diff < diff_save_threshold).any():
+                    return self.keys[shape][candidates[first][np.argmax(diff < diff_save_threshold)]]
+                candidates = np.delete(candidates, first)
+            if len(candidates):
+                diff = np.count_nonzero(bucket.images[candidates] != img_proc, axis=(1, 2))
+                if (diff < diff_save_threshold).any():
+                    return self.keys[shape][candidates[np.argmax(diff < diff_save_threshold)]]
+        return None
+
+
 # === 保存済み画像キャッシュ ===
 def load_saved_images_to_mem(directory):
-    mem_list = []
+    index = NoveltyIndex()
     for fname in sorted(os.listdir(directory)):
         path = os.path.join(directory, fname)
         img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
         if img is not None:
-            mem_list.append(preprocess_for_diff(img))
-    return mem_list
-
-saved_name_imgs = load_saved_images_to_mem(os.path.join(OUTPUT_DIR, 'name'))
-saved_effect_imgs = load_saved_images_to_mem(os.path.join(OUTPUT_DIR, 'effect'))
-print(f"既存キャッシュ: name={len(saved_name_imgs)}, effect={len(saved_effect_imgs)}")
-
-# === 差分判定 ===
-def is_new_image_mem(img_proc, saved_images_mem, diff_save_threshold):
-    for saved_proc in saved_images_mem:
-        if saved_proc.shape != img_proc.shape:
-            saved_resized = cv2.resize(saved_proc, (img_proc.shape[1], img_proc.shape[0]), interpolation=cv2.INTER_AREA)
-        else:
-            saved_resized = saved_proc
-        diff = cv2.countNonZero(cv2.absdiff(img_proc, saved_resized))
-        if diff < diff_save_threshold:
-            return False
-    return True
+            index.add(preprocess_for_diff(img))
+    return index
+
+# 処理開始時点の保存済み画像(各動画はこれと自分が切り出した画像だけで判定する)
+bank = {}
+
+def init_worker():
+    if bank:
+        return  # fork で起動した場合は親プロセスで読み込んだものを使う
+    bank["name"] = load_saved_images_to_mem(os.path.join(OUTPUT_DIR, 'name'))
+    bank["effect"] = load_saved_images_to_mem(os.path.join(OUTPUT_DIR, 'effect'))
 
 # === ROI座標 ===
 def scaled_rect(x1, y1, x2, y2, frame_w, frame_h):
@@ -61,13 +185,38 @@ def scaled_rect(x1, y1, x2, y2, frame_w, frame_h):
     ey = math.ceil(frame_h * y2 / CALC_BASE_HEIGHT)
     return {"x1": sx, "y1": sy, "x2": ex, "y2": ey}
 
+# === 効果欄の変化判定 ===
+class EffectGate:
+    """前回文字を切り出したフレームから rect 内が変化したかを、間引いたグレースケールの平均差分で判定する"""
+
+    def __init__(self, rect, stride=EFFECT_DIFF_STRIDE, threshold=EFFECT_DIFF_TH):
+        self.rect = rect
+        self.stride = stride
+        self.threshold = threshold
+        self.prev = None
+
+    def changed(self, frame):
+        r = self.rect
+        sig = cv2.cvtColor(frame[r["y1"]:r["y2"]:self.stride, r["x1"]:r["x2"]:self.stride], cv2.COLOR_BGR2GRAY)
+        if self.prev is not None and cv2.norm(self.prev, sig, cv2.NORM_L1) / sig.size <= self.threshold:
+            return False
+        self.prev = sig
+        return True
+
 # === 動画1本処理 ===
-def process_video(video_path):
-    global saved_name_imgs, saved_effect_imgs
+def process_video(video_path, show_progress=True):
+    """動画から保存候補の画像を切り出し、[(種類, ファイル名, 画像, 差分用画像, ログ, 親の候補番号)] を返す
 
-    cap = cv2.VideoCapture(video_path)
-    FRAME_WIDTH  = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    FRAME_HEIGHT = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    処理開始時点の保存済み画像(bank)と重複する画像は候補にしない。この動画で先に候補にした画像と重複する画像は、
+    一致した候補を親として残す(親が他の動画の画像と重複して保存されなかった場合に merge_candidates で判定し直す)。
+    先に判定した画像と画素が完全に一致する画像は、保存されるかがその画像と同じ判定になるので残さない。
+    """
+    cap = open_frame_source(video_path, FRAME_SOURCE, FRAME_SCALE)
+    if FRAME_SCALE is None and cap.full_size[1] not in (0, TEMPLATE_HEIGHT):
+        # 解像度の異なる動画でもテンプレートの文字サイズを揃える
+        cap.release()
+        cap = open_frame_source(video_path, FRAME_SOURCE, normalized_size(cap.full_size, TEMPLATE_HEIGHT))
+    FRAME_WIDTH, FRAME_HEIGHT = cap.full_size
     FRAME_COUNT  = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     print(f"\n▶ 処理開始: {video_path} ({FRAME_WIDTH}x{FRAME_HEIGHT}, {FRAME_COUNT} frames)")
 
@@ -81,6 +230,35 @@ def process_video(video_path):
         "effect3_1": scaled_rect(2220,1870,3820,1910, FRAME_WIDTH, FRAME_HEIGHT),
         "effect3_2": scaled_rect(2220,1918,3820,1960, FRAME_WIDTH, FRAME_HEIGHT),
     }
+    if CROP_IN_DECODER:
+        # 読み込むのは ROI 全体を囲む範囲だけなので、ROI をその範囲内の座標にする
+        cap.set_crop(union_rect(ROIS.values()))
+        ox, oy = cap.crop["x1"], cap.crop["y1"]
+        ROIS = {k: {"x1": r["x1"] - ox, "y1": r["y1"] - oy, "x2": r["x2"] - ox, "y2": r["y2"] - oy} for k, r in ROIS.items()}
+    effect_gate = EffectGate(union_rect(ROIS[f"effect{i}_{line}"] for i in range(1, 4) for line in (1, 2)))
+    char_width = int(CHAR_WIDTH_BASE * FRAME_WIDTH / CALC_BASE_WIDTH)
+
+    video_name = os.path.basename(video_path)
+    candidates = []
+    local = {"name": NoveltyIndex(), "effect": NoveltyIndex()}
+    children = {}  # 候補番号 → その候補を親とする候補の索引
+    seen = set()  # 判定済みの差分用画像の (種類, サイズ, 画素)
+
+    def propose(kind, fname, img_gray, img_proc, threshold, message):
+        key = (kind, img_proc.shape, img_proc.tobytes())
+        if key in seen:
+            return
+        seen.add(key)
+        if not bank[kind].is_new(img_proc, threshold):
+            return
+        # 重複する候補があれば、その子の中で重複しなくなるまでたどる
+        index, parent = local[kind], None
+        match = index.find(img_proc, threshold)
+        while match is not None:
+            index, parent = children.setdefault(match, NoveltyIndex()), match
+            match = index.find(img_proc, threshold)
+        index.add(img_proc, len(candidates))
+        candidates.append((kind, fname, img_gray, img_proc, message, parent))
 
     prev_name_gray = None
     frame_index = 0
@@ -96,49 +274,84 @@ def process_video(video_path):
         name_gray_proc = preprocess_for_diff(cv2.cvtColor(name_img, cv2.COLOR_BGR2GRAY))
         name_changed = prev_name_gray is None or cv2.countNonZero(cv2.absdiff(prev_name_gray, name_gray_proc)) > DIFF_SAVE_THRESHOLD_NAME
         if name_changed:
-            if is_new_image_mem(name_gray_proc, saved_name_imgs, DIFF_SAVE_THRESHOLD_NAME):
-                fname = os.path.join(OUTPUT_DIR, 'name', f"{os.path.basename(video_path)}_{frame_index}_name.png")
-                cv2.imwrite(fname, cv2.cvtColor(name_img, cv2.COLOR_BGR2GRAY))
-                saved_name_imgs.append(name_gray_proc)
-                print(f"[{os.path.basename(video_path)}] Frame {frame_index}: name saved")
+            propose("name", f"{video_name}_{frame_index}_name.png", cv2.cvtColor(name_img, cv2.COLOR_BGR2GRAY),
+                    name_gray_proc, DIFF_SAVE_THRESHOLD_NAME, f"[{video_name}] Frame {frame_index}: name saved")
             prev_name_gray = name_gray_proc
 
         # --- 遺物効果（文字単位） ---
-        for eff_idx in range(1,4):
-            for line in [1,2]:
-                key = f"effect{eff_idx}_{line}"
-                roi = ROIS[key]
-                eff_img = frame[roi["y1"]:roi["y2"], roi["x1"]:roi["x2"]]
-                if eff_img.shape[1] <= 0 or eff_img.shape[0] <= 0:
-                    continue
-                char_width = int(CHAR_WIDTH_BASE * FRAME_WIDTH / CALC_BASE_WIDTH)
-                n_chars = math.ceil(eff_img.shape[1] / char_width)
-                for c in range(n_chars):
-                    x1 = c*char_width
-                    x2 = min((c+1)*char_width, eff_img.shape[1])
-                    char_img = eff_img[:, x1:x2]
-                    if char_img.shape[1] <= 0:
+        # 効果欄が変化していないフレームは前回と同じ文字なので切り出さない
+        if effect_gate.changed(frame):
+            for eff_idx in range(1,4):
+                for line in [1,2]:
+                    key = f"effect{eff_idx}_{line}"
+                    roi = ROIS[key]
+                    eff_img = frame[roi["y1"]:roi["y2"], roi["x1"]:roi["x2"]]
+                    if eff_img.shape[1] <= 0 or eff_img.shape[0] <= 0:
                         continue
-                    char_gray_proc = preprocess_for_diff(cv2.cvtColor(char_img, cv2.COLOR_BGR2GRAY))
-                    if is_new_image_mem(char_gray_proc, saved_effect_imgs, DIFF_SAVE_THRESHOLD_CHAR):
-                        fname = os.path.join(OUTPUT_DIR, 'effect', f"{os.path.basename(video_path)}_{frame_index}_{key}_c{c}.png")
-                        cv2.imwrite(fname, cv2.cvtColor(char_img, cv2.COLOR_BGR2GRAY))
-                        saved_effect_imgs.append(char_gray_proc)
-                        print(f"[{os.path.basename(video_path)}] Frame {frame_index}: {key} char {c} saved")
-
-        # --- フレーム進める ---
+                    eff_gray = cv2.cvtColor(eff_img, cv2.COLOR_BGR2GRAY)
+                    n_chars = math.ceil(eff_img.shape[1] / char_width)
+                    for c in range(n_chars):
+                        x1 = c*char_width
+                        x2 = min((c+1)*char_width, eff_img.shape[1])
+                        char_gray = eff_gray[:, x1:x2]
+                        if char_gray.shape[1] <= 0:
+                            continue
+                        propose("effect", f"{video_name}_{frame_index}_{key}_c{c}.png", char_gray, preprocess_for_diff(char_gray),
+                                DIFF_SAVE_THRESHOLD_CHAR, f"[{video_name}] Frame {frame_index}: {key} char {c} saved")
+
+        # --- フレーム進める(シークせずに順に読み飛ばす) ---
         frame_index += FRAME_SKIP
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-        print(f"処理中: {frame_index}/{FRAME_COUNT} ({frame_index/FRAME_COUNT*100:.1f}%)", end='\r')
+        for _ in range(FRAME_SKIP - 1):
+            if not cap.read()[0]:
+                break
+        if show_progress:
+            print(f"処理中: {frame_index}/{FRAME_COUNT} ({frame_index/FRAME_COUNT*100:.1f}%)", end='\r')
 
     cap.release()
-    print(f"\n✅ 完了: {os.path.basename(video_path)}")
+    print(f"\n✅ 完了: {video_name}")
+    return candidates
+
+# === 候補の保存 ===
+def merge_candidates(candidates, saved):
+    """動画の処理順に、それまでに保存した画像(saved)と重複しない候補だけを保存する
+
+    親を保存した候補は親と重複するので比較しない。親が保存されなかった候補は saved と比較し直す。
+    """
+    saved_ids = set()
+    for i, (kind, fname, img_gray, img_proc, message, parent) in enumerate(candidates):
+        threshold = DIFF_SAVE_THRESHOLD_NAME if kind == "name" else DIFF_SAVE_THRESHOLD_CHAR
+        if parent in saved_ids or not saved[kind].is_new(img_proc, threshold):
+            continue
+        # 書きかけのファイルを読み込まないよう一時ファイルに書いてから置き換える
+        path = os.path.join(OUTPUT_DIR, kind, fname)
+        tmp_path = f"{path}.tmp"
+        cv2.imencode(".png", img_gray)[1].tofile(tmp_path)
+        os.replace(tmp_path, path)
+        saved[kind].add(img_proc)
+        saved_ids.add(i)
+        print(message)
+    return len(saved_ids)
 
 # === メイン ===
-video_files = sorted(glob(os.path.join(VIDEO_DIR, '*.mp4')))
-print(f"検出された動画: {len(video_files)} 件")
+if __name__ == "__main__":
+    init_worker()
+    saved = {kind: NoveltyIndex(img for imgs in index.saved.values() for img in imgs) for kind, index in bank.items()}
+    print(f"既存キャッシュ: name={len(saved['name'])}, effect={len(saved['effect'])}")
+
+    video_files = sorted(glob(os.path.join(VIDEO_DIR, '*.mp4')))
+    if FRAME_SOURCE in ("auto", "images"):
+        # スクリーンショットを置いたディレクトリも1本の動画として扱う
+        video_files += sorted(p for p in glob(os.path.join(VIDEO_DIR, '*')) if os.path.isdir(p))
+    print(f"検出された動画: {len(video_files)} 件")
 
-for vpath in video_files:
-    process_video(vpath)
+    workers = min(WORKERS, len(video_files))
+    if workers > 1:
+        # 各プロセスは動画ごとに候補を返すだけで、保存はこのプロセスが動画の順に行う
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            for candidates in executor.map(process_video, video_files, [False] * len(video_files)):
+                merge_candidates(candidates, saved)
+    else:
+        for vpath in video_files:
+            merge_candidates(process_video(vpath), saved)
 
-print("\n🎉 全動画の文字単位ラベル生成完了")
+    print("\n🎉 全動画の文字単位ラベル生成完了")
@@ -0,0 +1,379 @@
+import abc
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import cv2
+import numpy as np
+
+FRAME_SOURCES = ["auto", "opencv", "ffmpeg", "images"]
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+FFMPEG_BIN = os.environ.get("FFMPEG_BIN", "ffmpeg")
+FFPROBE_BIN = os.environ.get("FFPROBE_BIN", "ffprobe")
+# バッファを使い回す場合に、用途ごとに順に使う配列の数
+FRAME_POOL_SIZE = 2
+
+
+def parse_size(text):
+    """"1920x1080" → (1920, 1080)"""
+    try:
+        w, h = (int(v) for v in text.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"サイズは WIDTHxHEIGHT で指定してください: {text}")
+    if w <= 0 or h <= 0:
+        raise ValueError(f"サイズは WIDTHxHEIGHT で指定してください: {text}")
+    return w, h
+
+
+def normalized_size(size, height):
+    """縦横比を保ったまま高さを height にした (幅, 高さ)"""
+    w, h = size
+    return max(1, round(w * height / h)), height
+
+
+def imread_color(path):
+    # 日本語パス対策
+    data = np.fromfile(path, dtype=np.uint8)
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+# === フレームの供給元 ===
+class BufferRing:
+    """同じ用途の配列を size 個で順に使い回す
+
+    read で返したフレームを次の read で上書きしないよう size は 2 以上にする(読み込みに失敗しても直前のフレームは残る)。
+    """
+
+    def __init__(self, size=FRAME_POOL_SIZE):
+        self.arrays = [None] * size
+        self.pos = 0
+
+    def next(self):
+        """次に書き込む配列(まだ無ければ None)"""
+        return self.arrays[self.pos]
+
+    def keep(self, array):
+        """書き込んだ配列を保持して次に進む(形が変わって作り直された場合は差し替わる)"""
+        self.arrays[self.pos] = array
+        self.pos = (self.pos + 1) % len(self.arrays)
+        return array
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays if a is not None)
+
+
+class FrameSource(abc.ABC):
+    """cv2.VideoCapture と同じ read/get/set/release でフレームを返す
+
+    full_size は縮小後・切り出し前のフレームサイズ。set_crop で範囲を指定すると、read はその範囲だけを返す。
+    ROI は full_size を基準に計算し、crop の左上(x1, y1)を引いた座標で切り出す。
+    """
+
+    def __init__(self, full_size, frame_count, fps=0.0):
+        self.full_size = full_size
+        self.frame_count = frame_count
+        self.fps = fps
+        self.crop = None
+        self.pos = 0
+        self.rings = None
+
+    def enable_buffer_pool(self, size=FRAME_POOL_SIZE):
+        """デコード・縮小の出力先を用途ごとに size 個の配列で使い回す(read で返した配列は size - 1 回後の read まで有効)"""
+        self.rings = {}
+        self.pool_size = size
+
+    def buffer_bytes(self):
+        return sum(ring.nbytes for ring in self.rings.values()) if self.rings else 0
+
+    def _into(self, name):
+        """name の用途で次に書き込む配列(使い回さない場合・未確保の場合は None)"""
+        if self.rings is None:
+            return None
+        return self.rings.setdefault(name, BufferRing(self.pool_size)).next()
+
+    def _keep(self, name, array):
+        if self.rings is not None:
+            self.rings[name].keep(array)
+        return array
+
+    def set_crop(self, rect):
+        """rect(full_size 基準の x1/y1/x2/y2)の範囲だけを返すようにする。読み込み開始前に呼ぶ"""
+        w, h = self.full_size
+        x1, y1 = max(0, rect["x1"]), max(0, rect["y1"])
+        x2, y2 = min(w, rect["x2"]), min(h, rect["y2"])
+        self.crop = {"x1": x1, "y1": y1, "x2": x2, "y2": y2}
+
+    def _cropped(self, frame):
+        if self.crop is None:
+            return frame
+        c = self.crop
+        return frame[c["y1"]:c["y2"], c["x1"]:c["x2"]]
+
+    @abc.abstractmethod
+    def read(self):
+        """(成否, フレーム) を返す"""
+
+    @abc.abstractmethod
+    def seek(self, frame_idx):
+        """次の read で frame_idx(先頭が 0)のフレームを返すようにする"""
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self.frame_count)
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.full_size[0])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.full_size[1])
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.pos)
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        return 0.0
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        frame_idx = int(value)
+        # 順に読み進めている場合はシークしない
+        if frame_idx != self.pos:
+            self.seek(frame_idx)
+            self.pos = frame_idx
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class OpenCVSource(FrameSource):
+    """cv2.VideoCapture で動画を読み込む(縮小・切り出しは読み込み後に行う)"""
+
+    def __init__(self, path, scale=None):
+        self.cap = cv2.VideoCapture(path)
+        size = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.scale = scale if scale and tuple(scale) != size else None
+        super().__init__(tuple(scale or size), int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)), self.cap.get(cv2.CAP_PROP_FPS))
+
+    def read(self):
+        ret, frame = self.cap.read(self._into("decode"))
+        if not ret:
+            return False, None
+        frame = self._keep("decode", frame)
+        self.pos += 1
+        if self.scale:
+            frame = self._keep("scale", cv2.resize(frame, self.scale, dst=self._into("scale"), interpolation=cv2.INTER_AREA))
+        return True, self._cropped(frame)
+
+    def seek(self, frame_idx):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+
+    def release(self):
+        self.cap.release()
+
+
+class ImageSequenceSource(FrameSource):
+    """ディレクトリ内の PNG/JPG をファイル名順に1フレームずつ読み込む(スクリーンショットや連番画像)
+
+    サイズの異なる画像は先頭の画像(scale 指定時はそのサイズ)に合わせて拡大縮小する。
+    画像のデコードは毎回新しい配列になるため、使い回すのは拡大縮小の出力先だけ。
+    読み込めない画像は飛ばし、警告を log に渡す。
+    """
+
+    def __init__(self, directory, scale=None, log=print):
+        self.log = log
+        self.paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        size = (0, 0)
+        if self.paths:
+            first = imread_color(self.paths[0])
+            if first is not None:
+                size = first.shape[1::-1]
+        super().__init__(tuple(scale or size), len(self.paths))
+
+    def read(self):
+        while self.pos < len(self.paths):
+            frame = imread_color(self.paths[self.pos])
+            self.pos += 1
+            if frame is None:
+                self.log(f"⚠️ 画像が読み込めません: {self.paths[self.pos - 1]}")
+                continue
+            if frame.shape[1::-1] != self.full_size:
+                frame = self._keep(
+                    "scale", cv2.resize(frame, self.full_size, dst=self._into("scale"), interpolation=cv2.INTER_AREA)
+                )
+            return True, self._cropped(frame)
+        return False, None
+
+    def seek(self, frame_idx):
+        pass
+
+
+class FFmpegPipeSource(FrameSource):
+    """ffmpeg のサブプロセスでデコードし、-f rawvideo (bgr24) のフレームをパイプで受け取る
+
+    縮小(scale)と切り出し(crop)は ffmpeg のフィルタで行うため、Python には切り出した範囲の画素だけが渡る。
+    シーク時は入力側の -ss で指定フレームの時刻から出力し直す。可変フレームレートの動画でもずれないよう、
+    時刻は平均 fps ではなく各フレームのタイムスタンプから求める。
+    """
+
+    def __init__(self, path, scale=None, ffmpeg=FFMPEG_BIN, ffprobe=FFPROBE_BIN):
+        self.path = path
+        self.ffmpeg = ffmpeg
+        size, frame_count, fps = probe_video(path, ffprobe)
+        self.scale = scale if scale and tuple(scale) != size else None
+        super().__init__(tuple(scale or size), frame_count, fps)
+        self.proc = None
+        self.start_frame = 0
+        self._frame_times = None
+
+    def frame_times(self):
+        """表示順に並べた各フレームのタイムスタンプ(秒)。パケットを読むだけでデコードはしない"""
+        if self._frame_times is None:
+            out = subprocess.run(
+                [self.ffmpeg, "-v", "error", "-nostdin", "-i", self.path, "-map", "0:v:0", "-c", "copy",
+                 "-f", "framemd5", "-"],
+                capture_output=True, check=True, text=True,
+            ).stdout
+            time_base, pts = 1.0, []
+            for line in out.splitlines():
+                if line.startswith("#tb 0:"):
+                    num, _, den = line.split(":", 1)[1].strip().partition("/")
+                    time_base = int(num) / int(den)
+                elif line and not line.startswith("#"):
+                    pts.append(int(line.split(",")[2]))
+            self._frame_times = [p * time_base for p in sorted(pts)]
+        return self._frame_times
+
+    def command(self):
+        cmd = [self.ffmpeg, "-v", "error", "-nostdin"]
+        filters = []
+        if self.start_frame:
+            # 直前のキーフレームからデコードし、指定時刻より前のフレームは捨てる(-accurate_seek)
+            # タイムスタンプの丸めで前後のフレームにずれないよう、直前のフレームとの中間の時刻を指定する
+            times = self.frame_times()
+            k = min(self.start_frame, len(times))
+            seek_time = (times[k - 1] + times[k]) / 2 if k < len(times) else times[-1] + 1.0
+            cmd += ["-seek_timestamp", "1", "-accurate_seek", "-ss", f"{seek_time:.6f}"]
+        if self.scale:
+            filters.append(f"scale={self.scale[0]}:{self.scale[1]}:flags=area")
+        if self.crop:
+            # YUV のまま切り出すと色差の間引きに合わせて座標が丸められるため、BGR に変換してから切り出す
+            c = self.crop
+            filters.append("format=bgr24")
+            filters.append(f"crop={c['x2'] - c['x1']}:{c['y2'] - c['y1']}:{c['x1']}:{c['y1']}")
+        cmd += ["-i", self.path, "-an", "-sn", "-fps_mode", "passthrough"]
+        if filters:
+            cmd += ["-vf", ",".join(filters)]
+        return cmd + ["-f", "rawvideo", "-pix_fmt", "bgr24", "-"]
+
+    def _start(self):
+        # エラー出力はパイプだと読まない間に詰まるため一時ファイルに書かせ、異常終了時に読み出す
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(self.command(), stdout=subprocess.PIPE, stderr=self.stderr,
+                                         stdin=subprocess.DEVNULL)
+        except FileNotFoundError:
+            self.stderr.close()
+            raise RuntimeError(f"ffmpeg が見つかりません: {self.ffmpeg} (FFMPEG_BIN で指定できます)")
+
+    def _check_exit(self):
+        """出力が途切れたときに呼ぶ。ffmpeg が正常終了していれば終端、異常終了なら RuntimeError"""
+        returncode = self.proc.wait()
+        if returncode != 0:
+            self.stderr.seek(0)
+            message = self.stderr.read().decode("utf-8", "replace").strip()
+            raise RuntimeError(f"ffmpeg が異常終了しました (frame {self.pos}, 終了コード {returncode}): {message}")
+
+    def read(self):
+        if self.proc is None:
+            self._start()
+        if self.crop:
+            w, h = self.crop["x2"] - self.crop["x1"], self.crop["y2"] - self.crop["y1"]
+        else:
+            w, h = self.full_size
+        buf = self._into("decode")
+        if buf is None or buf.shape != (h, w, 3):
+            buf = np.empty((h, w, 3), dtype=np.uint8)
+        view = memoryview(buf).cast("B")
+        filled = 0
+        while filled < len(view):
+            n = self.proc.stdout.readinto(view[filled:])
+            if not n:
+                self._check_exit()
+                return False, None
+            filled += n
+        self.pos += 1
+        return True, self._keep("decode", buf)
+
+    def seek(self, frame_idx):
+        self.release()
+        self.start_frame = frame_idx
+
+    def release(self):
+        if self.proc is not None:
+            self.proc.stdout.close()
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+            self.stderr.close()
+
+
+def probe_video(path, ffprobe=FFPROBE_BIN):
+    """((幅, 高さ), フレーム数, fps) を返す。ffprobe が無ければ OpenCV で調べる"""
+    if shutil.which(ffprobe):
+        out = subprocess.run(
+            [ffprobe, "-v", "error", "-select_streams", "v:0", "-of", "json",
+             "-show_entries", "stream=width,height,nb_frames,avg_frame_rate,duration", path],
+            capture_output=True, check=True,
+        ).stdout
+        stream = json.loads(out)["streams"][0]
+        num, _, den = stream.get("avg_frame_rate", "0/1").partition("/")
+        fps = float(num) / float(den or 1) if float(den or 1) else 0.0
+        frame_count = int(stream.get("nb_frames") or round(float(stream.get("duration") or 0) * fps))
+        return (int(stream["width"]), int(stream["height"])), frame_count, fps
+
+    cap = cv2.VideoCapture(path)
+    try:
+        size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        return size, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS)
+    finally:
+        cap.release()
+
+
+def open_frame_source(path, backend="auto", scale=None, log=print):
+    """backend に応じた FrameSource を返す。auto はディレクトリなら images、それ以外は opencv
+
+    ffmpeg が見つからない場合は opencv で読み込む(ffprobe が無い場合は probe_video が OpenCV で調べる)。
+    警告は log に渡す。
+    """
+    if backend == "auto":
+        backend = "images" if os.path.isdir(path) else "opencv"
+    if backend == "images":
+        return ImageSequenceSource(path, scale, log)
+    if backend == "ffmpeg":
+        if shutil.which(FFMPEG_BIN) is None:
+            log(f"⚠️ ffmpeg が見つからないため OpenCV で読み込みます: {FFMPEG_BIN} (FFMPEG_BIN で指定できます)")
+            return OpenCVSource(path, scale)
+        return FFmpegPipeSource(path, scale)
+    if backend == "opencv":
+        return OpenCVSource(path, scale)
+    raise ValueError(f"未対応のフレーム供給元です: {backend}")
+
+
+def union_rect(rects):
+    """rects をすべて含む矩形"""
+    rects = list(rects)
+    return {
+        "x1": min(r["x1"] for r in rects), "y1": min(r["y1"] for r in rects),
+        "x2": max(r["x2"] for r in rects), "y2": max(r["y2"] for r in rects),
+    }
@@ -0,0 +1,488 @@
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import cv2
+
+import analyze_relics as ar
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# 実行中を除いて待機できるジョブ数。超えたら 429 を返す
+MAX_QUEUED_JOBS = 8
+# 終了したジョブの結果を保持する件数
+MAX_FINISHED_JOBS = 100
+# デコードの進捗イベントを送るフレーム間隔
+PROGRESS_INTERVAL_FRAMES = 30
+STREAM_KEEPALIVE_SECONDS = 15
+
+JOB_OPTIONS = {
+    "matcher": sorted(ar.MATCHER_BACKENDS),
+    "decoder": ["scan", "trie"],
+    "diff_gate": ["roi", "frame"],
+}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# === ジョブ ===
+class Job:
+    """解析ジョブ1件。進捗と確定した行をイベントとして貯め、購読者に順に配信する"""
+
+    def __init__(self, job_id, video, options, since=None, csv_path=None):
+        self.id = job_id
+        self.video = video
+        self.options = options
+        self.since = since
+        self.csv_path = csv_path
+        self.status = "queued"
+        self.error = None
+        self.rows = []
+        self.csv = None
+        self.total_frames = None
+        self.frame_idx = 0
+        self.created = time.time()
+        self.started = self.finished = None
+        self.cancel_requested = False
+        self.events = []
+        self.cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ("done", "error", "cancelled")
+
+    def emit(self, event_type, **data):
+        with self.cond:
+            self.events.append({"type": event_type, "job": self.id, **data})
+            self.cond.notify_all()
+
+    def iter_events(self, timeout=STREAM_KEEPALIVE_SECONDS):
+        """これまでのイベントから順に返す。新しいイベントが無いまま timeout 秒経つと None を返す"""
+        i = 0
+        while True:
+            with self.cond:
+                if i >= len(self.events) and not self.done:
+                    self.cond.wait(timeout)
+                events = self.events[i:]
+                finished = self.done
+            if not events:
+                if finished:
+                    return
+                yield None
+            i += len(events)
+            yield from events
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "video": self.video,
+            "options": self.options,
+            "since": self.since,
+            "status": self.status,
+            "error": self.error,
+            "frame": self.frame_idx,
+            "total_frames": self.total_frames,
+            "rows": len(self.rows),
+            "queued_seconds": (self.started or time.time()) - self.created,
+            "seconds": (self.finished or time.time()) - self.started if self.started else None,
+        }
+
+
+class JobCapture:
+    """cap.read() のたびに中断要求を確認し、一定間隔で進捗イベントを送る"""
+
+    def __init__(self, cap, job):
+        self._cap = cap
+        self.job = job
+
+    def read(self):
+        job = self.job
+        if job.cancel_requested:
+            raise JobCancelled()
+        ret, frame = self._cap.read()
+        if ret:
+            job.frame_idx += 1
+            if job.frame_idx % PROGRESS_INTERVAL_FRAMES == 0:
+                job.emit("progress", frame=job.frame_idx, total_frames=job.total_frames)
+        return ret, frame
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.job.frame_idx = int(value)
+        return self._cap.set(prop, value)
+
+    def __getattr__(self, name):
+        return getattr(self._cap, name)
+
+
+class JobOutput:
+    """analyze_relics の output として、確定した行をイベントで送る(StreamingCsvWriter と同じ呼び出し方)"""
+
+    def __init__(self, job):
+        self.job = job
+        self.rows = 0
+
+    def write_row(self, row):
+        self.rows += 1
+        self.job.rows.append(row)
+        self.job.emit("row", row=row)
+
+    def save_checkpoint(self, frame_idx, last_name, last_effects):
+        pass
+
+    def complete(self):
+        pass
+
+
+def rows_to_csv(rows, header=ar.CSV_HEADER):
+    buf = io.StringIO(newline="")
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buf.getvalue()
+
+
+def discard_log(*args, **kwargs):
+    """analyze_relics の log に渡してログ出力を捨てる"""
+
+
+# === ジョブキューと解析スレッド ===
+class AnalysisService:
+    """テンプレートと行キャッシュを常駐させ、キューに積まれたジョブを1件ずつ解析する"""
+
+    def __init__(self, max_queued=MAX_QUEUED_JOBS, use_template_cache=True):
+        started = time.perf_counter()
+        self.templates = ar.load_template_bank() if use_template_cache else ar.load_labeled_templates()
+        # 効果文の照合器は初回作成後モジュール内に保持される
+        ar.get_effect_matcher(ar.EFFECT_LIST)
+        ar.get_effect_matcher(ar.DISADVANTAGE_EFFECTS)
+        # 照合器と行キャッシュは照合バックエンドの設定ごとに分ける(設定が違うと同じ行画像でも認識結果が変わりうる)
+        self.engines = {}
+        self.engine(ar.DEFAULT_MATCHER_BACKEND, ar.DEFAULT_DECODER, ar.DEFAULT_CASCADE_K)
+        self.warmup_seconds = time.perf_counter() - started
+        self.max_queued = max_queued
+        self.jobs = OrderedDict()
+        self.pending = deque()
+        self.current = None
+        self.cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self.thread = threading.Thread(target=self._run, name="analysis", daemon=True)
+        self.thread.start()
+
+    def engine(self, matcher_backend, decoder, cascade_k):
+        """設定に対応する (照合器, 行キャッシュ) を返す。初回は作成して保持する"""
+        key = (matcher_backend, decoder, cascade_k)
+        if key not in self.engines:
+            self.engines[key] = (ar.create_matchers(self.templates, *key), ar.LineCache())
+        return self.engines[key]
+
+    def submit(self, video, options, since=None, csv_path=None):
+        """ジョブを追加する。キューが一杯なら None"""
+        with self.cond:
+            if len(self.pending) >= self.max_queued:
+                return None
+            job = Job(f"{next(self._ids)}", video, options, since, csv_path)
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            job.emit("queued", position=len(self.pending))
+            self._forget_finished()
+            self.cond.notify_all()
+            return job
+
+    def cancel(self, job):
+        with self.cond:
+            if job in self.pending:
+                self.pending.remove(job)
+                self._finish(job, "cancelled")
+            elif not job.done:
+                job.cancel_requested = True
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def _finish(self, job, status, error=None):
+        job.status, job.error, job.finished = status, error, time.time()
+        job.emit(status, **({"error": error} if error else {"rows": len(job.rows), "csv": job.csv}))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                job = self.current = self.pending.popleft()
+            job.status, job.started = "running", time.time()
+            job.emit("started")
+            try:
+                self._analyze(job)
+                self._finish(job, "done")
+            except JobCancelled:
+                self._finish(job, "cancelled")
+            except Exception as e:
+                self._finish(job, "error", f"{type(e).__name__}: {e}")
+            finally:
+                self.current = None
+
+    def _analyze(self, job):
+        cap = ar.open_relic_source(job.video, log=discard_log)
+        try:
+            ret, frame = cap.read()
+            if not ret:
+                raise ValueError(f"動画が読み込めません: {job.video}")
+            job.total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            known = ar.KnownRelics(ar.load_csv_rows(job.since)) if job.since else None
+            opts = job.options
+            matchers, line_cache = self.engine(opts["matcher"], opts["decoder"], opts["cascade_k"])
+            # 解析中のログ出力は捨てる(標準出力はサーバー全体で共有しているため、関数に渡して個別に捨てる)
+            rows = ar.analyze_relics(
+                JobCapture(cap, job), frame, self.templates, opts["matcher"], opts["diff_gate"],
+                opts["settle_frames"], line_cache=line_cache, decoder=opts["decoder"],
+                output=JobOutput(job), known=known, show_progress=False, cascade_k=opts["cascade_k"],
+                buffer_pool=opts["buffer_pool"], vote_frames=opts["vote_frames"],
+                min_confidence=opts["min_confidence"], confidence_columns=opts["confidence_columns"],
+                log=discard_log, matchers=matchers,
+            )
+            if job.cancel_requested:
+                raise JobCancelled()
+            if known is not None:
+                rows = known.merge(rows, discard_log)
+        finally:
+            cap.release()
+        job.rows = rows
+        header = ar.csv_header(opts["confidence_columns"])
+        job.csv = rows_to_csv(rows, header)
+        if job.csv_path:
+            ar.save_csv(rows, job.csv_path, header)
+
+    def status(self):
+        with self.cond:
+            return {
+                "warmup_seconds": self.warmup_seconds,
+                "running": self.current.id if self.current else None,
+                "queued": [job.id for job in self.pending],
+                "max_queued": self.max_queued,
+            }
+
+
+# === HTTP ===
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST   /jobs              {"video": 動画パス, "matcher"/"decoder"/"diff_gate"/"settle_frames"/"cascade_k"/"buffer_pool"/
+                              "vote_frames"/"min_confidence"/"confidence_columns", "since", "csv_path"}
+    GET    /jobs              ジョブ一覧
+    GET    /jobs/ID           ジョブの状態
+    GET    /jobs/ID/events    進捗と確定した行を NDJSON (Accept: text/event-stream なら SSE) で配信
+    GET    /jobs/ID/csv       完了したジョブの CSV
+    DELETE /jobs/ID           ジョブの中断
+    POST   /analyze           ジョブを追加してそのままイベントを配信
+    """
+
+    server_version = "enr-relics-importer"
+
+    def address_string(self):
+        # Unix ソケットの場合 client_address は空
+        return self.client_address[0] if self.client_address else "unix"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {"error": message})
+
+    def route(self):
+        parts = [p for p in urlsplit(self.path).path.split("/") if p]
+        job = None
+        if len(parts) >= 2 and parts[0] == "jobs":
+            job = self.service.jobs.get(parts[1])
+            if job is None:
+                self.send_error_json(HTTPStatus.NOT_FOUND, f"job {parts[1]} not found")
+                return None, None
+        return parts, job
+
+    def do_GET(self):
+        parts, job = self.route()
+        if parts is None:
+            return
+        if parts == ["health"]:
+            self.send_json(HTTPStatus.OK, {"status": "ok", **self.service.status()})
+        elif parts == ["jobs"]:
+            self.send_json(HTTPStatus.OK, [j.summary() for j in list(self.service.jobs.values())])
+        elif job is not None and len(parts) == 2:
+            self.send_json(HTTPStatus.OK, job.summary())
+        elif job is not None and parts[2:] == ["events"]:
+            self.stream_events(job)
+        elif job is not None and parts[2:] == ["csv"]:
+            if job.csv is None:
+                self.send_error_json(HTTPStatus.CONFLICT, f"job {job.id} is {job.status}")
+                return
+            body = job.csv.encode("utf-8")
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "text/csv; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error_json(HTTPStatus.NOT_FOUND, "not found")
+
+    def do_POST(self):
+        parts, _ = self.route()
+        if parts not in (["jobs"], ["analyze"]):
+            self.send_error_json(HTTPStatus.NOT_FOUND, "not found")
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+            video, options, since, csv_path = parse_job_request(request)
+        except ValueError as e:
+            self.send_error_json(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        job = self.service.submit(video, options, since, csv_path)
+        if job is None:
+            self.send_error_json(HTTPStatus.TOO_MANY_REQUESTS, "job queue is full")
+            return
+        if parts == ["analyze"]:
+            self.stream_events(job)
+        else:
+            self.send_json(HTTPStatus.ACCEPTED, job.summary())
+
+    def do_DELETE(self):
+        parts, job = self.route()
+        if parts is None:
+            return
+        if job is None or len(parts) != 2:
+            self.send_error_json(HTTPStatus.NOT_FOUND, "not found")
+            return
+        self.service.cancel(job)
+        self.send_json(HTTPStatus.OK, job.summary())
+
+    def stream_events(self, job):
+        sse = "text/event-stream" in (self.headers.get("Accept") or "")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/event-stream" if sse else "application/x-ndjson")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            for event in job.iter_events():
+                if event is None:
+                    # 接続維持用
+                    self.wfile.write(b": keepalive\n\n" if sse else b"\n")
+                elif sse:
+                    data = json.dumps(event, ensure_ascii=False)
+                    self.wfile.write(f"event: {event['type']}\ndata: {data}\n\n".encode("utf-8"))
+                else:
+                    self.wfile.write(json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが切断してもジョブは続ける(中断は DELETE で行う)
+            pass
+
+
+def parse_job_request(request):
+    """POST の JSON から (動画パス, 解析オプション, since, csv_path) を取り出す。不正なら ValueError"""
+    if not isinstance(request, dict):
+        raise ValueError("request body must be a JSON object")
+    video = request.get("video")
+    if not video or not os.path.isfile(video):
+        raise ValueError(f"video not found: {video}")
+    options = {
+        "matcher": request.get("matcher", ar.DEFAULT_MATCHER_BACKEND),
+        "decoder": request.get("decoder", ar.DEFAULT_DECODER),
+        "diff_gate": request.get("diff_gate", ar.DEFAULT_DIFF_GATE),
+        "settle_frames": request.get("settle_frames", ar.DEFAULT_SETTLE_FRAMES),
+        "cascade_k": request.get("cascade_k", ar.DEFAULT_CASCADE_K),
+        "buffer_pool": request.get("buffer_pool", False),
+        "vote_frames": request.get("vote_frames", ar.DEFAULT_VOTE_FRAMES),
+        "min_confidence": request.get("min_confidence", ar.DEFAULT_MIN_CONFIDENCE),
+        "confidence_columns": request.get("confidence_columns", False),
+    }
+    for name, choices in JOB_OPTIONS.items():
+        if options[name] not in choices:
+            raise ValueError(f"{name} must be one of {choices}")
+    if not isinstance(options["settle_frames"], int) or options["settle_frames"] < 0:
+        raise ValueError("settle_frames must be a non-negative integer")
+    if not isinstance(options["cascade_k"], int) or options["cascade_k"] < 1:
+        raise ValueError("cascade_k must be a positive integer")
+    if not isinstance(options["vote_frames"], int) or options["vote_frames"] < 0:
+        raise ValueError("vote_frames must be a non-negative integer")
+    if not isinstance(options["min_confidence"], (int, float)) or not 0 <= options["min_confidence"] <= 1:
+        raise ValueError("min_confidence must be a number between 0 and 1")
+    for name in ("buffer_pool", "confidence_columns"):
+        if not isinstance(options[name], bool):
+            raise ValueError(f"{name} must be a boolean")
+    since = request.get("since")
+    if since and not os.path.isfile(since):
+        raise ValueError(f"since csv not found: {since}")
+    if since and ar.load_csv_header(since) != ar.csv_header(options["confidence_columns"]):
+        raise ValueError(f"since csv columns do not match confidence_columns={options['confidence_columns']}: {since}")
+    return video, options, since, request.get("csv_path")
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=None):
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.service = service
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="テンプレートを常駐させて遺物解析ジョブを受け付けるローカルサーバー")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"待ち受けアドレス (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"待ち受けポート (default: {DEFAULT_PORT})")
+    parser.add_argument("--unix-socket", help="TCP の代わりに Unix ドメインソケットで待ち受ける")
+    parser.add_argument(
+        "--max-queued", type=int, default=MAX_QUEUED_JOBS,
+        help=f"実行中を除いて待機できるジョブ数 (default: {MAX_QUEUED_JOBS})",
+    )
+    parser.add_argument("--no-template-cache", action="store_true", help="テンプレートキャッシュを使わない")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    service = AnalysisService(args.max_queued, use_template_cache=not args.no_template_cache)
+    server = create_server(service, args.host, args.port, args.unix_socket)
+    where = args.unix_socket or f"http://{args.host}:{args.port}"
+    print(f"✅ Templates loaded in {service.warmup_seconds:.2f}s. Listening on {where}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()